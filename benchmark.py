@@ -0,0 +1,744 @@
+import argparse
+import base64
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import psycopg2
+
+# Runs the bot handlers against a throwaway database, a mock NOWPayments server and a fake Bot.
+# main.py reads config.json from the working directory on import, so it is imported only after the
+# benchmark wrote its own config into a temporary directory.
+
+main = None
+SCENARIOS = ['start_storm', 'checkout_burst', 'checkout_pooled', 'check_spam', 'check_latency', 'fulfill_race', 'broadcast',
+             'query_plans', 'pool_scaling', 'user_stream', 'dispatch', 'circuit_faults', 'ipn_signature']
+# Run one operation at a time, the broadcast has its own workers, plan checks patch the cursor and
+# the user stream and dispatch measure a single loop and the circuit faults are injected in sequence
+SERIAL_SCENARIOS = ('broadcast', 'query_plans', 'user_stream', 'dispatch', 'circuit_faults', 'ipn_signature')
+# scenario -> measurement besides latency, filled in by its operations and printed below its row
+scenario_details = {}
+
+
+class MockPaymentsHandler(BaseHTTPRequestHandler):
+    def reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def count(self):
+        path = self.path.split('?')[0]
+        path = '/v1/payment' if path.startswith('/v1/payment') else path
+        with self.server.lock:
+            self.server.calls[path] = self.server.calls.get(path, 0) + 1
+        time.sleep(self.server.latency)
+        return path
+
+    def do_GET(self):
+        path = self.count()
+        if self.server.failing:
+            self.send_response(503)
+            self.end_headers()
+        elif path == '/v1/status':
+            self.reply({'message': 'OK'})
+        elif path == '/v1/payment' and self.path.split('?')[0].rstrip('/') != '/v1/payment':
+            self.reply({'payment_id': self.path.rpartition('/')[2], 'payment_status': self.server.payment_status})
+        elif path == '/v1/payment':
+            invoice_id = self.path.partition('invoiceId=')[2].partition('&')[0]
+            self.reply({'data': [{'payment_id': f'p{invoice_id}', 'invoice_id': invoice_id,
+                                  'payment_status': self.server.payment_status}], 'pagesCount': 1})
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.count()
+        if self.server.failing:
+            self.send_response(503)
+            self.end_headers()
+        elif path == '/v1/auth':
+            claims = base64.urlsafe_b64encode(json.dumps({'exp': time.time() + 300}).encode()).decode().rstrip('=')
+            self.reply({'token': f'header.{claims}.signature'})
+        elif path == '/v1/invoice':
+            invoice_id = str(uuid.uuid4().int % 10 ** 12)
+            self.reply({'id': invoice_id, 'order_id': body.get('order_id'),
+                        'invoice_url': f'https://nowpayments.invalid/invoice/{invoice_id}'})
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockPaymentsServer(ThreadingHTTPServer):
+    # The default backlog of 5 refuses connections once the concurrency goes above it
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_mock_payments(latency):
+    server = MockPaymentsServer(('127.0.0.1', 0), MockPaymentsHandler)
+    server.calls = {}
+    server.lock = threading.Lock()
+    server.latency = latency
+    server.payment_status = 'waiting'
+    # Set by the circuit_faults scenario, every call then gets a 503 like during an outage
+    server.failing = False
+    threading.Thread(target=server.serve_forever, name='mock-payments', daemon=True).start()
+    return server
+
+
+class FakeBot:
+    # Stands in for telegram.Bot and for the bot behind update.message and update.callback_query
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def call(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        time.sleep(self.latency)
+        return SimpleNamespace(message_id=1, photo=[SimpleNamespace(file_id='photo')],
+                               video=SimpleNamespace(file_id='video'))
+
+    def send_message(self, *args, **kwargs):
+        return self.call('sendMessage')
+
+    def send_photo(self, *args, **kwargs):
+        return self.call('sendPhoto')
+
+    def send_video(self, *args, **kwargs):
+        return self.call('sendVideo')
+
+    def send_document(self, *args, **kwargs):
+        return self.call('sendDocument')
+
+    def edit_message_text(self, *args, **kwargs):
+        return self.call('editMessageText')
+
+
+def fake_user(user_id):
+    return SimpleNamespace(id=user_id, username=f'user{user_id}')
+
+
+def message_update(bot, user_id, text):
+    message = SimpleNamespace(from_user=fake_user(user_id), chat_id=user_id, text=text,
+                              reply_text=lambda *args, **kwargs: bot.call('sendMessage'))
+    return SimpleNamespace(message=message, effective_user=message.from_user, callback_query=None)
+
+
+def callback_update(bot, user_id, data):
+    query = SimpleNamespace(from_user=fake_user(user_id), data=data, edits=[], texts=[])
+
+    def edit_message_text(text=None, reply_markup=None, **kwargs):
+        query.edits.append(reply_markup)
+        query.texts.append(text)
+        return bot.call('editMessageText')
+
+    query.answer = lambda *args, **kwargs: bot.call('answerCallbackQuery')
+    query.edit_message_text = edit_message_text
+    return SimpleNamespace(callback_query=query, effective_user=query.from_user, message=None)
+
+
+def button_data(update, text):
+    for row in update.callback_query.edits[-1].inline_keyboard:
+        for button in row:
+            if button.text == text:
+                return button.callback_data
+    raise LookupError(f'No "{text}" button in the reply')
+
+
+def db_query_count():
+    with main.metrics_lock:
+        return sum(count for (name, _), (_, _, count) in main.metric_histograms.items()
+                   if name == 'bot_db_query_seconds')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(name, operations, concurrency, payments, bot, finish=None):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def timed(operation):
+        started = time.perf_counter()
+        try:
+            operation()
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    payments_before = dict(payments.calls)
+    bot_before = dict(bot.calls)
+    queries_before = db_query_count()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, operations))
+    # Work the operations left behind, like buffered writes, counts towards the scenario
+    if finish:
+        finish()
+    elapsed = time.perf_counter() - started
+    queries = db_query_count() - queries_before
+    result = {
+        'scenario': name,
+        'operations': len(latencies),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'db_queries': queries,
+        'db_queries_per_operation': round(queries / len(latencies), 2) if latencies else 0.0,
+        'payments_calls': {path: count - payments_before.get(path, 0) for path, count in payments.calls.items()
+                           if count != payments_before.get(path, 0)},
+        'bot_calls': {method: count - bot_before.get(method, 0) for method, count in bot.calls.items()
+                      if count != bot_before.get(method, 0)},
+    }
+    if errors:
+        result['first_error'] = errors[0]
+    if name in scenario_details:
+        result['detail'] = scenario_details.pop(name)
+    return result
+
+
+def start_storm(bot, users):
+    context = SimpleNamespace(bot=bot, args=[])
+    # Every user presses /start twice, the second one takes the known-user path
+    return [lambda user_id=user_id: main.start(message_update(bot, user_id, '/start'), context)
+            for user_id in list(range(1, users + 1)) * 2]
+
+
+def pool_scaling(bot, users, concurrency, payments):
+    # The same /start storm with more pool slots each time, throughput should grow with the pool size
+    slots = main.db_pool_slots
+    results = []
+    try:
+        for size in sorted({1, 2, 4, 8, 16, concurrency} & set(range(1, concurrency + 1))):
+            main.db_pool_slots = threading.BoundedSemaphore(size)
+            # Known users skip the upsert, every round has to write them again
+            main.known_users.clear()
+            results.append(run_scenario(f'pool_scaling/{size}', start_storm(bot, users), concurrency, payments, bot))
+    finally:
+        main.db_pool_slots = slots
+    return results
+
+
+def checkout(bot, user_id, context):
+    update = callback_update(bot, user_id, 'buy_ticket')
+    main.button_click(update, context)
+    if main.catalog_index[0]:
+        sku = main.catalog_index[1][user_id % len(main.catalog_index[1])]
+        update = callback_update(bot, user_id, f'product_{sku}')
+        main.button_click(update, context)
+    confirm = callback_update(bot, user_id, button_data(update, '🛒 Buy'))
+    main.button_click(confirm, context)
+    return button_data(confirm, 'I Paid').partition('_')[2]
+
+
+def checkout_burst(bot, users, orders, first_user_id=1):
+    context = SimpleNamespace(bot=bot, args=[])
+
+    def operation(user_id):
+        orders.append((user_id, checkout(bot, user_id, context)))
+
+    return [lambda user_id=user_id: operation(user_id) for user_id in range(first_user_id, first_user_id + users)]
+
+
+def checkout_pooled(bot, users, concurrency, payments, unpooled):
+    # The same burst by other users with a pool filled beforehand, every checkout should take a pooled invoice
+    # instead of waiting for /v1/invoice. The run without the pool is checkout_burst.
+    enabled, size = main.INVOICE_POOL_ENABLED, main.INVOICE_POOL_SIZE
+    main.INVOICE_POOL_ENABLED = True
+    # Checkouts spread evenly over the products, each price point needs its share of the users
+    main.INVOICE_POOL_SIZE = -(-users // max(len(main.catalog_index[1]), 1))
+    try:
+        main.fill_invoice_pool()
+        result = run_scenario('checkout_pooled', checkout_burst(bot, users, [], users + 1), concurrency, payments, bot)
+    finally:
+        main.INVOICE_POOL_ENABLED, main.INVOICE_POOL_SIZE = enabled, size
+        with main.get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('DELETE FROM invoice_pool')
+    missed = result['payments_calls'].get('/v1/invoice', 0)
+    if missed:
+        result['errors'] += missed
+        result['first_error'] = f'{missed} checkouts requested an invoice instead of taking a pooled one'
+    if unpooled:
+        result['detail'] = f'without the pool: p50 {unpooled["p50_ms"]} ms, p99 {unpooled["p99_ms"]} ms'
+    return result
+
+
+def check_spam(bot, orders, presses, replies=None):
+    context = SimpleNamespace(bot=bot, args=[])
+
+    def press(user_id, order_id):
+        update = callback_update(bot, user_id, f'check_{order_id}')
+        main.button_click(update, context)
+        if replies is not None:
+            replies.append(update.callback_query.texts[-1] if update.callback_query.texts else None)
+
+    # Each owner presses "Check transaction" repeatedly, like an impatient buyer
+    return [lambda user_id=user_id, order_id=order_id: press(user_id, order_id)
+            for user_id, order_id in orders for _ in range(presses)]
+
+
+def check_latency(bot, orders):
+    # One press per order with nothing cached, so each press waits for the payment API like a first check does
+    with main.check_status_lock:
+        main.check_status_cache.clear()
+        main.last_check_presses.clear()
+    return check_spam(bot, orders, 1)
+
+
+def fulfill_race(bot, orders, payments, presses, replies):
+    # All orders are paid now and every press for them runs at once, each order still gets one ticket
+    # and every press reports it as successful. The cooldown is lifted so repeated presses reach
+    # fulfill_order instead of being turned away.
+    payments.payment_status = 'finished'
+    main.settings = main.settings._replace(check_cooldown=0)
+    with main.check_status_lock:
+        main.check_status_cache.clear()
+        main.last_check_presses.clear()
+    return check_spam(bot, orders, presses, replies)
+
+
+def verify_fulfillment(result, orders, replies):
+    with main.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT count(*), count(DISTINCT uuid) FROM tickets WHERE uuid = ANY(%s)',
+                       ([order_id for _, order_id in orders],))
+        tickets, ticketed_orders = cursor.fetchone()
+    result['tickets'] = tickets
+    if tickets != len(orders) or ticketed_orders != len(orders):
+        result['errors'] += 1
+        result['first_error'] = f'{tickets} tickets for {ticketed_orders} of {len(orders)} paid orders'
+    unsuccessful = [reply for reply in replies if reply != 'Transaction successful!']
+    if unsuccessful:
+        result['errors'] += len(unsuccessful)
+        result['first_error'] = f'{len(unsuccessful)} presses for paid orders replied: {unsuccessful[0]!r}'
+
+
+def seed_users(count):
+    with main.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO users (user_id, username, register_timestamp) '
+                       'SELECT g, \'user\' || g, current_timestamp FROM generate_series(1, %s) AS g '
+                       'ON CONFLICT (user_id) DO NOTHING', (count,))
+
+
+def user_stream(users):
+    # Reads every user in keyset pages like the broadcast and through the server-side cursor like the
+    # users export, peak memory has to stay at about one page for both. tracemalloc sees Python objects only,
+    # the itersize rows libpq buffers for the cursor are not in its peak.
+    seed_users(users)
+
+    def measure(read):
+        tracemalloc.start()
+        try:
+            streamed = read()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return streamed, peak // 1024
+
+    def operation():
+        paged, paged_peak = measure(lambda: sum(len(chunk) for chunk in main.iter_user_chunks()))
+        cursor, cursor_peak = measure(lambda: sum(1 for _ in main.get_all_users()))
+        if paged != cursor:
+            raise AssertionError(f'keyset pages read {paged} users, the server-side cursor {cursor}')
+        scenario_details['user_stream'] = (f'{paged} users streamed with a peak of {paged_peak} KiB in keyset pages, '
+                                           f'{cursor_peak} KiB through the server-side cursor')
+
+    return [operation]
+
+
+def dispatch(callbacks):
+    # Menu buttons and an unknown one against a Bot that answers at once, what is left is the routing cost
+    bot = FakeBot(0)
+    context = SimpleNamespace(bot=bot, args=[])
+    data = ['terms', 'back', 'buy_ticket', 'unknown_button']
+    updates = [callback_update(bot, index % 1000, data[index % len(data)]) for index in range(callbacks)]
+
+    def operation():
+        started = time.perf_counter()
+        for update in updates:
+            main.button_click(update, context)
+        elapsed = time.perf_counter() - started
+        scenario_details['dispatch'] = f'{elapsed / callbacks * 1e6:.1f} us per callback'
+
+    return [operation]
+
+
+def circuit_faults(bot, payments):
+    # Walks the breaker through an outage of the mock API: open, failed probe, single probe, close on success
+    context = SimpleNamespace(bot=bot, args=[])
+    order_id = str(uuid.uuid4())
+    with main.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO transactions (uuid, username, invoice_id, payment_timestamp, user_id) '
+                       'VALUES (%s, %s, %s, current_timestamp, %s)', (order_id, 'user1', 'circuit', 1))
+
+    def expect(condition, message):
+        if not condition:
+            raise AssertionError(f'{message}, circuit is {main.payments_circuit["state"]}')
+
+    def api_calls():
+        with payments.lock:
+            return sum(payments.calls.values())
+
+    def status_request():
+        try:
+            main.payments_request('GET', '/v1/status')
+            return 'sent'
+        except main.CircuitOpenError:
+            return 'rejected'
+
+    def operation():
+        saved_settings, saved_latency = main.settings, payments.latency
+        main.settings = main.settings._replace(circuit_min_calls=5, circuit_failure_rate=0.5,
+                                               circuit_reset_timeout=0.2, circuit_half_open_probes=1)
+        # Calls of earlier scenarios are still in the window and would outvote the injected failures
+        with main.payments_circuit_lock:
+            main.payments_circuit_results.clear()
+            main.payments_circuit.update(state='closed', opened_at=0.0, probes=0)
+        try:
+            payments.failing = True
+            for _ in range(main.settings.circuit_min_calls):
+                status_request()
+            expect(main.payments_circuit['state'] == 'open', 'failed calls did not open the circuit')
+
+            calls = api_calls()
+            update = callback_update(bot, 1, f'check_{order_id}')
+            main.button_click(update, context)
+            expect(api_calls() == calls, 'an open circuit still called the API')
+            expect(update.callback_query.texts[-1].startswith('Temporary unavailability'),
+                   'an open circuit did not show the unavailability reply')
+
+            time.sleep(main.settings.circuit_reset_timeout)
+            expect(status_request() == 'sent' and main.payments_circuit['state'] == 'open',
+                   'a failed probe did not re-open the circuit')
+
+            time.sleep(main.settings.circuit_reset_timeout)
+            payments.failing = False
+            payments.latency = 0.3
+            probe = threading.Thread(target=status_request)
+            probe.start()
+            time.sleep(0.1)
+            expect(main.payments_circuit['state'] == 'half_open', 'the circuit did not half-open after the timeout')
+            expect(status_request() == 'rejected', 'a second request passed while the probe was running')
+            probe.join()
+            expect(main.payments_circuit['state'] == 'closed', 'a successful probe did not close the circuit')
+            payments.latency = saved_latency
+            expect(status_request() == 'sent', 'a closed circuit rejected a request')
+
+            # Calls sent before the outage that only end while the probe runs must not decide for it
+            _, stale = main.payments_circuit_allows_request()
+            payments.failing = True
+            for _ in range(main.settings.circuit_min_calls):
+                status_request()
+            expect(main.payments_circuit['state'] == 'open', 'failed calls did not open the circuit again')
+            time.sleep(main.settings.circuit_reset_timeout)
+            is_allowed, probe_of = main.payments_circuit_allows_request()
+            expect(is_allowed and probe_of is not None, 'the circuit sent no probe after the timeout')
+            main.record_payments_result(True, stale)
+            expect(main.payments_circuit['state'] == 'half_open', 'a call from before the outage closed the circuit')
+            main.record_payments_result(False, stale)
+            expect(main.payments_circuit['state'] == 'half_open',
+                   'a call from before the outage re-opened the circuit')
+            main.record_payments_result(True, probe_of)
+            expect(main.payments_circuit['state'] == 'closed', 'the probe result did not close the circuit')
+        finally:
+            main.settings, payments.latency, payments.failing = saved_settings, saved_latency, False
+            with main.payments_circuit_lock:
+                main.payments_circuit.update(state='closed', probes=0)
+                main.payments_circuit_results.clear()
+            main.invalidate_order_status(order_id)
+
+    return [operation]
+
+
+# A callback as NOWPayments sends it, signed in Node with the sorted JSON.stringify from their documentation.
+# A tiny crypto amount and non-ASCII text are where json.dumps defaults would compute another signature.
+IPN_TEST_SECRET = 'test-ipn-secret'
+IPN_TEST_BODY = (
+    '{"payment_status":"finished","payment_id":5077125051,"invoice_id":4522625843,"pay_amount":0.00008,'
+    '"actually_paid":0.00008,"price_amount":5,"price_currency":"usd","pay_currency":"btc",'
+    '"order_id":"2256e173-10cc-4023-8ca4-80b6ca163233","order_description":"Футболка \\"Кот\\" / 🐱",'
+    '"outcome_amount":0.0000791,"fee":{"currency":"btc","depositFee":0,"withdrawalFee":0.0000012,"serviceFee":0},'
+    '"updated_at":1700000000000}'
+).encode()
+IPN_TEST_SIGNATURE = ('a55e3f3f26deaa42d73ae714cb4aceeac85070b9987b3f09bdefddb5520574179a87dab1482176d97bf1d7ab69'
+                      'cbe2c9723037f496e1d2e434c0d893cca42267')
+
+
+def ipn_signature():
+    def operation():
+        saved_secret = main.IPN_SECRET
+        main.IPN_SECRET = IPN_TEST_SECRET
+        try:
+            data = main.verify_ipn_signature(IPN_TEST_BODY, IPN_TEST_SIGNATURE)
+            if data is None:
+                raise AssertionError('a correctly signed NOWPayments callback was rejected')
+            if data['pay_amount'] != 0.00008:
+                raise AssertionError(f'pay_amount parsed as {data["pay_amount"]!r}')
+            tampered = IPN_TEST_BODY.replace(b'"pay_amount":0.00008', b'"pay_amount":0.00009')
+            if main.verify_ipn_signature(tampered, IPN_TEST_SIGNATURE) is not None:
+                raise AssertionError('a changed callback passed the signature check')
+        finally:
+            main.IPN_SECRET = saved_secret
+
+    return [operation]
+
+
+def broadcast(bot, users):
+    seed_users(users)
+    with main.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO messages (text) VALUES (%s)', ('Benchmark broadcast',))
+
+    def operation():
+        main.broadcast_lock.acquire()
+        main.run_broadcast(bot, 0, main.get_last_message())
+
+    return [operation]
+
+
+# The check_ path by order_id, each of these has to reach transactions through an index
+PLAN_CHECKS = [
+    ('is_transaction_in', lambda order_id: main.is_transaction_in(order_id)),
+    ('save_order_state', lambda order_id: main.save_order_state(order_id, 'waiting')),
+    ('fulfill_order', lambda order_id: main.fulfill_order(order_id, 'benchmark')),
+]
+
+
+@contextmanager
+def captured_statements():
+    statements = []
+    execute = main.TimedCursor.execute
+
+    def capture(cursor, query, vars=None):
+        statements.append(cursor.mogrify(query, vars).decode())
+        return execute(cursor, query, vars)
+
+    main.TimedCursor.execute = capture
+    try:
+        yield statements
+    finally:
+        main.TimedCursor.execute = execute
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def seed_transactions(count):
+    # A third of the orders is fulfilled, like a shop with some history
+    with main.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO transactions (uuid, username, invoice_id, payment_timestamp, is_paid, '
+                       'is_use_for_ticket, payment_status) '
+                       'SELECT md5(g::text), \'user\' || g, g::text, current_timestamp - make_interval(secs => g), '
+                       'g %% 3 = 0, g %% 3 = 0, CASE WHEN g %% 3 = 0 THEN \'finished\' END '
+                       'FROM generate_series(1, %s) AS g', (count,))
+        cursor.execute('ANALYZE transactions')
+
+
+def query_plans(transactions):
+    seed_transactions(transactions)
+
+    def check(name, call):
+        # An unknown order changes nothing, only the statements it runs are explained
+        with captured_statements() as statements:
+            call(str(uuid.uuid4()))
+        with main.get_connection() as conn, conn.cursor() as cursor:
+            scans = []
+            for statement in statements:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {statement}')
+                scans += [node['Node Type'] for node in plan_nodes(cursor.fetchone()[0][0]['Plan'])
+                          if node.get('Relation Name') == 'transactions']
+        if not scans or 'Seq Scan' in scans:
+            raise AssertionError(f'{name} reads transactions with {scans or "no scan"}')
+
+    return [lambda name=name, call=call: check(name, call) for name, call in PLAN_CHECKS]
+
+
+def seed_products(count):
+    with main.get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO products (sku, title, price, stock) '
+                       'SELECT \'bench\' || g, \'Product \' || g, 5 + g, 1000000 FROM generate_series(1, %s) AS g',
+                       (count,))
+    main.load_catalog()
+
+
+def create_database(args):
+    name = f'bench_{os.getpid()}_{int(time.time())}'
+    connection = psycopg2.connect(dbname=args.db_name, user=args.db_user, password=args.db_password,
+                                  host=args.db_host, port=args.db_port)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE {name}')
+    return connection, name
+
+
+def write_config(args, database, payments_url):
+    config = {
+        'telegram_token': '123456:benchmark', 'base_url': payments_url, 'price': 5, 'admins': [0],
+        'db_name': database, 'user_db': args.db_user, 'pass_db': args.db_password, 'host_db': args.db_host,
+        'port_db': args.db_port, 'db_pool_max': args.concurrency + 4, 'payments_pool_size': args.concurrency,
+        'payments_max_concurrency': args.concurrency, 'broadcast_rate': args.broadcast_rate,
+        'broadcast_progress_interval': 3600, 'metrics_port': 0, 'reconcile_interval': 0,
+        'config_watch_interval': 0, 'check_cooldown': 0, 'log_level': 'WARNING',
+    }
+    with open('config.json', 'w') as config_file:
+        json.dump(config, config_file, indent=4)
+
+
+def print_results(results):
+    print(f'{"scenario":<16}{"ops":>8}{"err":>6}{"ops/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"db":>9}{"db/op":>8}  calls')
+    for result in results:
+        calls = ', '.join(f'{name}={count}' for name, count in
+                          sorted({**result['payments_calls'], **result['bot_calls']}.items()))
+        print(f'{result["scenario"]:<16}{result["operations"]:>8}{result["errors"]:>6}{result["throughput"]:>10}'
+              f'{result["p50_ms"]:>10}{result["p99_ms"]:>10}{result["db_queries"]:>9}'
+              f'{result["db_queries_per_operation"]:>8}  {calls}')
+        if 'detail' in result:
+            print(f'  {result["detail"]}')
+        if 'first_error' in result:
+            print(f'  first error: {result["first_error"]}')
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    # A scenario regresses when it got slower at p99 or lost throughput by more than the tolerance
+    with open(baseline_path) as baseline_file:
+        baseline = {result['scenario']: result for result in json.load(baseline_file)}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if before is None:
+            continue
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append(f'{result["scenario"]}: p99 {before["p99_ms"]} -> {result["p99_ms"]} ms')
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f'{result["scenario"]}: throughput {before["throughput"]} -> {result["throughput"]}')
+        if result['db_queries'] > before['db_queries'] * (1 + tolerance):
+            regressions.append(f'{result["scenario"]}: db queries {before["db_queries"]} -> {result["db_queries"]}')
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return not regressions
+
+
+def run(args):
+    global main
+    payments = start_mock_payments(args.api_latency / 1000)
+    bot = FakeBot(args.bot_latency / 1000)
+    admin_connection, database = create_database(args)
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    os.chdir(workdir)
+    write_config(args, database, f'http://127.0.0.1:{payments.server_port}')
+    try:
+        main = importlib.import_module('main')
+        if args.products:
+            seed_products(args.products)
+        orders = []
+        fulfill_replies = []
+        scenarios = {
+            'start_storm': lambda: start_storm(bot, args.users),
+            'checkout_burst': lambda: checkout_burst(bot, args.users, orders),
+            'check_spam': lambda: check_spam(bot, orders, args.check_presses),
+            'check_latency': lambda: check_latency(bot, orders),
+            'fulfill_race': lambda: fulfill_race(bot, orders, payments, args.check_presses, fulfill_replies),
+            'broadcast': lambda: broadcast(bot, args.broadcast_users),
+            'user_stream': lambda: user_stream(args.stream_users),
+            'dispatch': lambda: dispatch(args.dispatch_callbacks),
+            'circuit_faults': lambda: circuit_faults(bot, payments),
+            'ipn_signature': ipn_signature,
+            'query_plans': lambda: query_plans(args.plan_transactions),
+        }
+        results = []
+        for name in args.scenarios:
+            if name == 'pool_scaling':
+                results += pool_scaling(bot, args.users, args.concurrency, payments)
+                continue
+            if name == 'checkout_pooled':
+                unpooled = next((result for result in results if result['scenario'] == 'checkout_burst'), None)
+                results.append(checkout_pooled(bot, args.users, args.concurrency, payments, unpooled))
+                continue
+            concurrency = 1 if name in SERIAL_SCENARIOS else args.concurrency
+            # The buffered last_interaction writes of the storm are flushed inside its measurement
+            finish = main.flush_last_interactions if name == 'start_storm' else None
+            results.append(run_scenario(name, scenarios[name](), concurrency, payments, bot, finish))
+            if name == 'fulfill_race':
+                verify_fulfillment(results[-1], orders, fulfill_replies)
+        main.flush_last_interactions()
+    finally:
+        # The database can only be dropped once the bot's connections are closed, also after a failed scenario
+        if main is not None:
+            main.db_pool.closeall()
+        payments.shutdown()
+        with admin_connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE IF EXISTS {database}')
+        admin_connection.close()
+    return results
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description='Load-test the bot handlers with a fake Bot and mock NOWPayments')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-password', default='')
+    parser.add_argument('--db-name', default='postgres', help='database to connect to for creating the test one')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--users', type=int, default=1000, help='users in the /start and checkout scenarios')
+    parser.add_argument('--check-presses', type=int, default=10, help='check presses per order')
+    parser.add_argument('--broadcast-users', type=int, default=100000)
+    parser.add_argument('--broadcast-rate', type=float, default=1000000,
+                        help='messages per second, the default measures the bot instead of the Telegram limit')
+    parser.add_argument('--stream-users', type=int, default=1000000, help='users seeded for the user stream')
+    parser.add_argument('--dispatch-callbacks', type=int, default=20000, help='callbacks routed by dispatch')
+    parser.add_argument('--products', type=int, default=0, help='sell from a catalog of this many products')
+    parser.add_argument('--plan-transactions', type=int, default=200000,
+                        help='transactions seeded before the query plans are checked')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--api-latency', type=float, default=50, help='NOWPayments response time in ms')
+    parser.add_argument('--bot-latency', type=float, default=20, help='Bot API response time in ms')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+    if args.baseline and not compare_with_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+    # Failed operations, a fulfillment mismatch or a plan check make the run fail
+    if any(result['errors'] for result in results):
+        sys.exit(1)
@@ -1,16 +1,72 @@
+import argparse
+import atexit
+import base64
+import functools
+import hashlib
+import hmac
 import logging
+import re
+import select
+import signal
+import sys
+import tempfile
 import uuid
 import psycopg2
 import json
 import os
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
 import requests
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from requests.adapters import HTTPAdapter
+from psycopg2 import pool, sql
+from psycopg2.extras import execute_values
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN, cursor as base_cursor
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+from telegram.utils.request import Request
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
 
 log_filename = 'log.txt'
-logging.basicConfig(filename=log_filename, level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOG_CONTEXT_FIELDS = ('user_id', 'order_id', 'invoice_id')
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    # The default prepare() formats the message in the calling thread, here the listener thread does it
+    def prepare(self, record):
+        return record
+
+
+# Handlers only put records on the queue, formatting and file writes happen in the listener thread
+# that starts once the log settings are read from the config
+log_queue = queue.SimpleQueue()
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(DeferredQueueHandler(log_queue))
 logger = logging.getLogger(__name__)
 
 logger.info('Service start')
@@ -18,460 +74,1671 @@ logger.info('Service start')
 CONFIG_FILE = 'config.json'
 
 
-def create_empty_config():
-    empty_config = {}
-    with open(CONFIG_FILE, 'w') as config_file:
-        json.dump(empty_config, config_file)
-        logger.info(f'Create empty {CONFIG_FILE}')
+NUMBER = (int, float)
+# key -> (default, accepted types), in the order keys are written to a new config file
+CONFIG_SCHEMA = {
+    'nowpayments_api_key': ("", str),
+    'telegram_token': ("", str),
+    'base_url': ("", str),
+    'login_payments': ("", str),
+    'pass_payments': ("", str),
+    'price': (5, NUMBER),
+    'help_user_id': ("", (int, str)),
+    'admins': ([], list),
+    'db_name': ("", str),
+    'user_db': ("", str),
+    'pass_db': ("", str),
+    'host_db': ("", str),
+    'port_db': ("", (int, str)),
+    'db_pool_min': (1, int),
+    'db_pool_max': (10, int),
+    'db_health_check_interval': (30, NUMBER),
+    'payments_timeout': (10, NUMBER),
+    'payments_pool_size': (10, int),
+    'auth_token_ttl': (300, NUMBER),
+    'auth_token_refresh_margin': (30, NUMBER),
+    'ipn_secret': ("", str),
+    'ipn_host': ("0.0.0.0", str),
+    'ipn_port': (8080, int),
+    'ipn_callback_url': ("", str),
+    'reconcile_interval': (60, NUMBER),
+    'reconcile_batch_size': (100, int),
+    'reconcile_min_backoff': (60, NUMBER),
+    'reconcile_max_backoff': (3600, NUMBER),
+    'payments_max_concurrency': (4, int),
+    'broadcast_rate': (25, NUMBER),
+    'broadcast_workers': (8, int),
+    'broadcast_retries': (3, int),
+    'broadcast_chunk_size': (200, int),
+    'broadcast_progress_interval': (10, NUMBER),
+    'users_itersize': (2000, int),
+    'last_interaction_flush_interval': (30, NUMBER),
+    'last_interaction_flush_size': (500, int),
+    'update_workers': (8, int),
+    'slow_update_workers': (16, int),
+    'check_status_ttl': (5, NUMBER),
+    'check_cooldown': (3, NUMBER),
+    'check_cache_size': (10000, int),
+    'circuit_window': (20, int),
+    'circuit_min_calls': (5, int),
+    'circuit_failure_rate': (0.5, NUMBER),
+    'circuit_reset_timeout': (30, NUMBER),
+    'circuit_half_open_probes': (1, int),
+    'metrics_host': ("127.0.0.1", str),
+    'metrics_port': (9100, int),
+    'tracing': (False, bool),
+    'log_level': ("INFO", str),
+    'log_max_bytes': (10485760, int),
+    'log_backup_count': (5, int),
+    'log_rotate_when': ("", str),
+    'catalog_page_size': (8, int),
+    'invoice_pool_size': (0, int),
+    'invoice_pool_refill_interval': (60, NUMBER),
+    'invoice_pool_max_age': (86400, NUMBER),
+    'report_days': (30, int),
+    # Payments of a day can still change until its invoices expire, older days are rolled up into daily_sales
+    'report_settle_days': (7, int),
+    'config_watch_interval': (5, NUMBER),
+    'telegram_api_url': ("", str),
+    'webhook_url': ("", str),
+    'webhook_secret': ("", str),
+    'webhook_host': ("0.0.0.0", str),
+    'webhook_port': (8443, int),
+    'webhook_max_connections': (40, int),
+    'webhook_queue_size': (1000, int),
+    'webhook_peers': ([], list),
+    'webhook_shard': (0, int),
+    'webhook_record_file': ("", str),
+    # Chat ids the support tickets are spread over, help_user_id alone when empty
+    'support_operators': ([], list),
+    'support_digest_interval': (60, NUMBER),
+    'support_digest_size': (10, int),
+    'support_notify_rate': (1, NUMBER),
+    # Seconds an invoice can still be paid, NOWPayments gives up on it after 7 days
+    'invoice_lifetime': (604800, NUMBER),
+    'known_users_cache_size': (100000, int),
+    # Catalog units of invoices unpaid past invoice_lifetime go back to stock, checked this often
+    'stock_release_interval': (300, NUMBER),
+}
+# Checks beyond the type, numbers are also never allowed to be negative
+CONFIG_CHECKS = {
+    'price': (lambda value: value > 0, 'must be greater than 0'),
+    'db_pool_max': (lambda value: value >= 1, 'must be at least 1'),
+    'payments_pool_size': (lambda value: value >= 1, 'must be at least 1'),
+    'payments_max_concurrency': (lambda value: value >= 1, 'must be at least 1'),
+    'broadcast_rate': (lambda value: value > 0, 'must be greater than 0'),
+    'broadcast_workers': (lambda value: value >= 1, 'must be at least 1'),
+    'update_workers': (lambda value: value >= 1, 'must be at least 1'),
+    'slow_update_workers': (lambda value: value >= 1, 'must be at least 1'),
+    'circuit_failure_rate': (lambda value: 0 < value <= 1, 'must be in (0, 1]'),
+    'catalog_page_size': (lambda value: value >= 1, 'must be at least 1'),
+    'report_days': (lambda value: value >= 1, 'must be at least 1'),
+    'webhook_queue_size': (lambda value: value >= 1, 'must be at least 1'),
+    'support_operators': (lambda value: all(isinstance(operator, (int, str)) and not isinstance(operator, bool)
+                                            for operator in value), 'must be a list of chat ids'),
+    'support_digest_interval': (lambda value: value > 0, 'must be greater than 0'),
+    'support_digest_size': (lambda value: value >= 1, 'must be at least 1'),
+    'support_notify_rate': (lambda value: value > 0, 'must be greater than 0'),
+    'invoice_lifetime': (lambda value: value > 0, 'must be greater than 0'),
+    'webhook_secret': (lambda value: re.fullmatch(r'[A-Za-z0-9_-]{0,256}', value),
+                       'may only contain up to 256 of A-Z, a-z, 0-9, _ and -'),
+    'log_level': (lambda value: isinstance(logging.getLevelName(value), int), 'must be a logging level name'),
+    # The values TimedRotatingFileHandler accepts, it raises on anything else while the bot starts
+    'log_rotate_when': (lambda value: re.fullmatch(r'|[SMHD]|MIDNIGHT|W[0-6]', value.upper()),
+                        'must be empty, S, M, H, D, midnight or W0 to W6'),
+}
+# Read through `settings` when used, so a change in the config file applies without a restart.
+# Everything else sizes pools, threads or connections at startup and needs one.
+RELOADABLE_SETTINGS = frozenset({
+    'price', 'help_user_id', 'admins', 'payments_timeout', 'auth_token_ttl', 'auth_token_refresh_margin',
+    'ipn_callback_url', 'reconcile_min_backoff', 'reconcile_max_backoff', 'broadcast_retries',
+    'broadcast_progress_interval', 'check_status_ttl', 'check_cooldown', 'circuit_min_calls',
+    'circuit_failure_rate', 'circuit_reset_timeout', 'circuit_half_open_probes', 'tracing', 'log_level',
+    'catalog_page_size', 'invoice_pool_max_age', 'report_days', 'report_settle_days', 'support_operators',
+    'support_digest_size', 'invoice_lifetime',
+})
+Settings = namedtuple('Settings', CONFIG_SCHEMA)
+
+
+class ConfigError(ValueError):
+    pass
 
 
 def load_config():
     if not os.path.exists(CONFIG_FILE):
-        create_empty_config()
-
+        return {}
     with open(CONFIG_FILE) as config_file:
         logger.info(f'Load {CONFIG_FILE}')
         return json.load(config_file)
 
 
 def save_config(config):
-    with open(CONFIG_FILE, 'w') as config_file:
+    # Replaced in one step, so the watcher never reads a half-written file
+    with open(f'{CONFIG_FILE}.tmp', 'w') as config_file:
         json.dump(config, config_file, indent=4)
-        logger.info(f'Save updates {CONFIG_FILE}')
+    os.replace(f'{CONFIG_FILE}.tmp', CONFIG_FILE)
+    logger.info(f'Save updates {CONFIG_FILE}')
+
+
+def parse_config(config):
+    if not isinstance(config, dict):
+        raise ConfigError(f'{CONFIG_FILE} must contain a JSON object')
+    values = {}
+    for key, (default, types) in CONFIG_SCHEMA.items():
+        value = config.get(key, default)
+        # bool is an int subclass, but true is no valid port or pool size
+        if not isinstance(value, types) or isinstance(value, bool) != (types is bool):
+            raise ConfigError(f'{key} has invalid value {value!r}')
+        if isinstance(value, NUMBER) and value < 0:
+            raise ConfigError(f'{key} must not be negative')
+        check, message = CONFIG_CHECKS.get(key, (None, None))
+        if check and not check(value):
+            raise ConfigError(f'{key} {message}')
+        values[key] = value
+    if values['webhook_url'] and not values['webhook_secret']:
+        raise ConfigError('webhook_secret is required when webhook_url is set')
+    if values['webhook_peers'] and values['webhook_shard'] >= len(values['webhook_peers']):
+        raise ConfigError('webhook_shard must be an index into webhook_peers')
+    return Settings(**values)
 
 
 config = load_config()
+settings = parse_config(config)
+# The file is only written when keys are missing, e.g. on first start or after an upgrade added settings
+if any(key not in config for key in CONFIG_SCHEMA):
+    save_config({**settings._asdict(), **config})
+CONFIG_WATCH_INTERVAL = settings.config_watch_interval
+
+
+def config_file_version():
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+config_file_state = {'version': config_file_version()}
+
+
+def reload_config(context: CallbackContext = None):
+    global settings
+    version = config_file_version()
+    if version == config_file_state['version']:
+        return
+    config_file_state['version'] = version
+    try:
+        new_settings = parse_config(load_config())
+    except (OSError, ValueError) as e:
+        logger.error(f'In func reload_config keep current settings, {CONFIG_FILE} is invalid: {e}')
+        return
+    changed = [key for key in CONFIG_SCHEMA if getattr(new_settings, key) != getattr(settings, key)]
+    restart_required = [key for key in changed if key not in RELOADABLE_SETTINGS]
+    if restart_required:
+        logger.warning(f'In func reload_config {", ".join(restart_required)} changed, restart the bot to apply')
+    applied = {key: getattr(new_settings, key) for key in changed if key in RELOADABLE_SETTINGS}
+    if not applied:
+        return
+    # One assignment swaps all changed values, a reader sees either the old or the new settings
+    settings = settings._replace(**applied)
+    logging.getLogger().setLevel(settings.log_level)
+    logger.info(f'In func reload_config applied {", ".join(applied)}')
+
+
+LOG_MAX_BYTES = settings.log_max_bytes
+LOG_BACKUP_COUNT = settings.log_backup_count
+LOG_ROTATE_WHEN = settings.log_rotate_when
+
+
+def create_log_file_handler():
+    # log_rotate_when ("midnight", "H", ...) switches from size-based to time-based rotation
+    if LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(log_filename, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT,
+                                           encoding='utf-8')
+    else:
+        handler = RotatingFileHandler(log_filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                      encoding='utf-8')
+    handler.setFormatter(JsonLogFormatter())
+    return handler
+
+
+logging.getLogger().setLevel(settings.log_level)
+log_listener = QueueListener(log_queue, create_log_file_handler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
+NOWPAYMENTS_API_KEY = settings.nowpayments_api_key
+TOKEN = settings.telegram_token
+BASE_URL = settings.base_url
+LOGIN_PAYMENTS = settings.login_payments
+PASS_PAYMENTS = settings.pass_payments
+PAYMENTS_POOL_SIZE = settings.payments_pool_size
+IPN_SECRET = settings.ipn_secret
+IPN_HOST = settings.ipn_host
+IPN_PORT = settings.ipn_port
+# With IPN callbacks the stored payment status is kept up to date, so "Check transaction" reads it locally
+IPN_ENABLED = bool(IPN_SECRET)
+# NOWPayments callbacks are a few hundred bytes, anything far larger is not one
+IPN_MAX_BODY_SIZE = 65536
+NOTIFY_PAYMENT_STATUSES = ('finished', 'partially_paid', 'failed', 'refunded', 'expired')
+FINAL_PAYMENT_STATUSES = ('finished', 'failed', 'refunded', 'expired')
+RECONCILE_INTERVAL = settings.reconcile_interval
+RECONCILE_BATCH_SIZE = settings.reconcile_batch_size
+# The reconciler polls every open invoice, so button presses never have to call the payment API
+RECONCILE_ENABLED = RECONCILE_INTERVAL > 0
+PAYMENTS_MAX_CONCURRENCY = settings.payments_max_concurrency
+CIRCUIT_WINDOW = settings.circuit_window
+BROADCAST_RATE = settings.broadcast_rate
+BROADCAST_WORKERS = settings.broadcast_workers
+BROADCAST_CHUNK_SIZE = settings.broadcast_chunk_size
+USERS_ITERSIZE = settings.users_itersize
+KNOWN_USERS_CACHE_SIZE = settings.known_users_cache_size
+STOCK_RELEASE_INTERVAL = settings.stock_release_interval
+LAST_INTERACTION_FLUSH_INTERVAL = settings.last_interaction_flush_interval
+LAST_INTERACTION_FLUSH_SIZE = settings.last_interaction_flush_size
+UPDATE_WORKERS = settings.update_workers
+SLOW_UPDATE_WORKERS = settings.slow_update_workers
+# Callbacks that wait on the payment API run on their own pool, so they can't starve quick replies
+SLOW_CALLBACK_PREFIXES = ('confirm', 'check')
+CHECK_CACHE_SIZE = settings.check_cache_size
+# These statuses never change again, so their lookups are cached until evicted
+TERMINAL_PAYMENT_STATUSES = ('finished', 'expired', 'refunded')
+# Reserved stock goes back on sale once the invoice can no longer be paid
+STOCK_RELEASE_STATUSES = ('expired', 'failed', 'refunded')
+# Order state after a payment status arrives: created -> pending -> paid -> fulfilled, or failed on the way.
+# A late "finished" still pays a failed order, fulfilled is only ever set by fulfill_order and refunded
+# only by the operator's refund. Neither changes on a payment status afterwards.
+ORDER_STATE_TRANSITION = (
+    "CASE WHEN {status} = 'finished' AND state IN ('created', 'pending', 'failed') THEN 'paid' "
+    "WHEN {status} IN ('failed', 'expired', 'refunded') AND state IN ('created', 'pending') THEN 'failed' "
+    "WHEN {status} IS NOT NULL AND state = 'created' THEN 'pending' "
+    "ELSE state END"
+)
+INVOICE_POOL_SIZE = settings.invoice_pool_size
+INVOICE_POOL_REFILL_INTERVAL = settings.invoice_pool_refill_interval
+# Invoices created ahead of time per price point, checkout then only takes one from the table
+INVOICE_POOL_ENABLED = INVOICE_POOL_SIZE > 0
+TELEGRAM_API_URL = settings.telegram_api_url
+WEBHOOK_URL = settings.webhook_url
+WEBHOOK_SECRET = settings.webhook_secret
+WEBHOOK_HOST = settings.webhook_host
+WEBHOOK_PORT = settings.webhook_port
+WEBHOOK_MAX_CONNECTIONS = settings.webhook_max_connections
+WEBHOOK_QUEUE_SIZE = settings.webhook_queue_size
+WEBHOOK_PEERS = settings.webhook_peers
+WEBHOOK_SHARD = settings.webhook_shard
+WEBHOOK_RECORD_FILE = settings.webhook_record_file
+# Telegram posts updates to webhook_url instead of the bot polling getUpdates
+WEBHOOK_ENABLED = bool(WEBHOOK_URL)
+SUPPORT_DIGEST_INTERVAL = settings.support_digest_interval
+SUPPORT_NOTIFY_RATE = settings.support_notify_rate
+SUPPORT_NOTIFY_ATTEMPTS = 3
+
+DB_NAME = settings.db_name
+USER_DB = settings.user_db
+PASS_DB = settings.pass_db
+HOST_DB = settings.host_db
+PORT_DB = settings.port_db
+
+DB_POOL_MIN = settings.db_pool_min
+DB_POOL_MAX = settings.db_pool_max
+DB_HEALTH_CHECK_INTERVAL = settings.db_health_check_interval
+
+METRICS_HOST = settings.metrics_host
+METRICS_PORT = settings.metrics_port
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# (name, labels) -> [cumulative bucket counts, sum, count] and (name, labels) -> value
+metric_histograms = {}
+metric_counters = {}
+metrics_lock = threading.Lock()
+# Set per update while tracing is on, spans recorded by the handling thread are logged with its order_id
+trace_state = threading.local()
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metric_histograms.get(key)
+        if histogram is None:
+            histogram = metric_histograms[key] = [[0] * len(METRIC_BUCKETS), 0.0, 0]
+        for index, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+    trace = getattr(trace_state, 'trace', None)
+    if trace:
+        logger.info(f'Trace {trace["id"]} order_id = {trace["order_id"]} span {name} {labels} '
+                    f'took {seconds * 1000:.1f} ms')
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + value
+
+
+@contextmanager
+def timed(name, **labels):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
 
-if 'nowpayments_api_key' not in config:
-    config['nowpayments_api_key'] = ""
-if 'telegram_token' not in config:
-    config['telegram_token'] = ""
-if 'base_url' not in config:
-    config['base_url'] = ""
-if 'login_payments' not in config:
-    config['login_payments'] = ""
-if 'pass_payments' not in config:
-    config['pass_payments'] = ""
-if 'price' not in config:
-    config['price'] = 5
-if 'help_user_id' not in config:
-    config['help_user_id'] = ""
-if 'db_name' not in config:
-    config['db_name'] = ""
-if 'user_db' not in config:
-    config['user_db'] = ""
-if 'pass_db' not in config:
-    config['pass_db'] = ""
-if 'host_db' not in config:
-    config['host_db'] = ""
-if 'port_db' not in config:
-    config['port_db'] = ""
-
-save_config(config)
-
-NOWPAYMENTS_API_KEY = config.get("nowpayments_api_key")
-TOKEN = config.get("telegram_token")
-BASE_URL = config.get("base_url")
-LOGIN_PAYMENTS = config.get("login_payments")
-PASS_PAYMENTS = config.get("pass_payments")
-PRICE = config.get("price")
-HELP_USER_ID = config.get("help_user_id")
-ADMINS = config.get("admins")
-
-DB_NAME = config.get("db_name")
-USER_DB = config.get("user_db")
-PASS_DB = config.get("pass_db")
-HOST_DB = config.get("host_db")
-PORT_DB = config.get("port_db")
-
-conn = psycopg2.connect(
+@contextmanager
+def traced(order_id):
+    if not settings.tracing:
+        yield
+        return
+    trace_state.trace = {'id': uuid.uuid4().hex[:16], 'order_id': order_id}
+    try:
+        yield
+    finally:
+        trace_state.trace = None
+
+
+def statement_label(query):
+    # "SELECT transactions" rather than the full text, to keep the label set small
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    elif not isinstance(query, str):
+        return 'composed'
+    words = query.split()
+    table = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)', query, re.IGNORECASE)
+    return f'{words[0].upper() if words else ""} {table.group(1) if table else ""}'.strip()
+
+
+class TimedCursor(base_cursor):
+    def execute(self, query, vars=None):
+        with timed('bot_db_query_seconds', statement=statement_label(query)):
+            return super().execute(query, vars)
+
+
+class TimedRequest(Request):
+    def _request_wrapper(self, method, url, *args, **kwargs):
+        # The Bot API method is the last path segment, the token before it must not end up in a label
+        with timed('bot_http_request_seconds', target='telegram', path=url.rsplit('/', 1)[-1]):
+            return super()._request_wrapper(method, url, *args, **kwargs)
+
+# One keep-alive session for all NOWPayments calls, so requests reuse TLS connections
+payments_session = requests.Session()
+payments_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=PAYMENTS_POOL_SIZE))
+payments_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=PAYMENTS_POOL_SIZE))
+payments_executor = ThreadPoolExecutor(max_workers=PAYMENTS_POOL_SIZE, thread_name_prefix='payments')
+payments_slots = threading.BoundedSemaphore(PAYMENTS_MAX_CONCURRENCY)
+
+# Circuit breaker over every NOWPayments call: closed -> open after too many failures in the window,
+# open -> half_open after circuit_reset_timeout, half_open -> closed on a successful probe
+payments_circuit = {'state': 'closed', 'opened_at': 0.0, 'probes': 0}
+payments_circuit_results = deque(maxlen=CIRCUIT_WINDOW)
+payments_circuit_lock = threading.Lock()
+
+# JWT from /v1/auth, shared by all workers until shortly before it expires
+auth_token_cache = {'token': None, 'expires_at': 0.0}
+auth_token_lock = threading.Lock()
+auth_token_stats = {'hits': 0, 'misses': 0, 'refresh_on_401': 0}
+
+db_pool = pool.ThreadedConnectionPool(
+    DB_POOL_MIN,
+    DB_POOL_MAX,
     dbname=f"{DB_NAME}",
     user=f"{USER_DB}",
     password=f"{PASS_DB}",
     host=f"{HOST_DB}",
-    port=f"{PORT_DB}"
+    port=f"{PORT_DB}",
+    cursor_factory=TimedCursor
 )
+# ThreadedConnectionPool raises PoolError when exhausted, so worker threads wait for a free slot instead
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+connection_last_used = {}
 
-cursor = conn.cursor()
 
-with conn:
-    with conn.cursor() as cursor:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id bigint PRIMARY KEY,
-                username TEXT,
-                register_timestamp TIMESTAMP DEFAULT current_timestamp,
-                last_interaction TIMESTAMP
-            )
-        ''')
-        logger.info('Table users create')
+def is_connection_healthy(connection):
+    if connection.closed or connection.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+        return False
+    # Only ping connections that sat idle long enough for the server or a proxy to drop them
+    if time.monotonic() - connection_last_used.get(id(connection), 0) < DB_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        connection.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+    return True
+
+
+def checkout_connection():
+    # Broken connections are discarded, getconn() then opens a fresh one
+    for _ in range(DB_POOL_MAX + 1):
+        connection = db_pool.getconn()
+        if is_connection_healthy(connection):
+            return connection
+        logger.info('Discard broken connection from pool')
+        connection_last_used.pop(id(connection), None)
+        db_pool.putconn(connection, close=True)
+    raise psycopg2.OperationalError('No healthy connection available in pool')
+
+
+@contextmanager
+def get_connection():
+    db_pool_slots.acquire()
+    broken = False
+    try:
+        connection = checkout_connection()
+        try:
+            with connection:
+                yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            broken = broken or bool(connection.closed)
+            if broken:
+                connection_last_used.pop(id(connection), None)
+            else:
+                connection_last_used[id(connection)] = time.monotonic()
+            db_pool.putconn(connection, close=broken)
+    finally:
+        db_pool_slots.release()
 
+
+@contextmanager
+def job_lock(lock_id):
+    # Held while a job calls the payments API, so it takes its own connection instead of a pool slot
+    connection = psycopg2.connect(dbname=f"{DB_NAME}", user=f"{USER_DB}", password=f"{PASS_DB}",
+                                  host=f"{HOST_DB}", port=f"{PORT_DB}")
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (lock_id,))
+            yield cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+# Schema versions applied in order at startup, each migration runs once and is recorded in schema_migrations.
+# The first two use IF NOT EXISTS, so databases created before the runner existed are adopted as they are.
+MIGRATIONS = [
+    (1, 'create base tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id bigint PRIMARY KEY,
+            username TEXT,
+            register_timestamp TIMESTAMP DEFAULT current_timestamp,
+            last_interaction TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            transaction_id SERIAL PRIMARY KEY,
+            uuid TEXT,
+            username TEXT,
+            is_paid BOOLEAN DEFAULT FALSE,
+            invoice_id TEXT,
+            is_use_for_ticket BOOLEAN DEFAULT FALSE,
+            payment_timestamp TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            text TEXT,
+            path_to_photo TEXT,
+            path_to_video TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS invoices (
+            id SERIAL PRIMARY KEY,
+            order_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            record_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'payment status, broadcast progress and media file ids', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE',
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS user_id bigint',
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS payment_status TEXT',
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS status_checked_at TIMESTAMP',
+        'ALTER TABLE messages ADD COLUMN IF NOT EXISTS photo_file_id TEXT',
+        'ALTER TABLE messages ADD COLUMN IF NOT EXISTS video_file_id TEXT',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            message_id INTEGER,
+            last_user_id bigint DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            started_at TIMESTAMP DEFAULT current_timestamp,
+            finished_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (3, 'tickets table and indexes for order lookups', [
+        '''
+        CREATE TABLE IF NOT EXISTS tickets (
+            ticket_id SERIAL PRIMARY KEY,
+            username TEXT,
+            uuid TEXT,
+            ticket_timestamp TIMESTAMP DEFAULT current_timestamp
+        )
+        ''',
+        # is_transaction_in: latest unused transaction of an order
+        'CREATE INDEX IF NOT EXISTS transactions_uuid_unused_idx ON transactions (uuid, payment_timestamp DESC) '
+        'WHERE is_use_for_ticket = FALSE',
+        # check_ finalization updates every row of an order
+        'CREATE INDEX IF NOT EXISTS transactions_uuid_idx ON transactions (uuid)',
+        # IPN callbacks and the reconciler write back by invoice_id
+        'CREATE INDEX IF NOT EXISTS transactions_invoice_id_idx ON transactions (invoice_id)',
+        # the reconciler scans only unpaid invoices
+        'CREATE INDEX IF NOT EXISTS transactions_unpaid_idx ON transactions (payment_timestamp) WHERE is_paid = FALSE',
+        'CREATE INDEX IF NOT EXISTS invoices_order_id_idx ON invoices (order_id)',
+        'CREATE INDEX IF NOT EXISTS tickets_uuid_idx ON tickets (uuid)',
+    ]),
+    (4, 'products catalog with change notifications', [
+        # confirm_<order_id>_<sku> has to fit the 64 bytes of Telegram callback data
+        '''
+        CREATE TABLE products (
+            sku TEXT PRIMARY KEY CHECK (octet_length(sku) <= 19 AND sku <> ''),
+            title TEXT NOT NULL,
+            price NUMERIC(12, 2) NOT NULL CHECK (price > 0),
+            currency TEXT NOT NULL DEFAULT 'usd',
+            stock INTEGER NOT NULL DEFAULT 0 CHECK (stock >= 0),
+            is_active BOOLEAN NOT NULL DEFAULT TRUE
+        )
+        ''',
+        'ALTER TABLE transactions ADD COLUMN sku TEXT',
+        'ALTER TABLE transactions ADD COLUMN price_amount NUMERIC(12, 2)',
+        'ALTER TABLE transactions ADD COLUMN price_currency TEXT',
+        'ALTER TABLE transactions ADD COLUMN stock_released BOOLEAN DEFAULT FALSE',
+        # The payload is the changed sku, listeners reload only that product
+        '''
+        CREATE FUNCTION notify_products_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('products_changed', COALESCE(NEW.sku, OLD.sku));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER products_changed AFTER INSERT OR UPDATE OR DELETE ON products
+        FOR EACH ROW EXECUTE PROCEDURE notify_products_changed()
+        ''',
+    ]),
+    (5, 'pool of pre-created invoices', [
+        '''
+        CREATE TABLE invoice_pool (
+            id SERIAL PRIMARY KEY,
+            invoice_id TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            invoice_url TEXT NOT NULL,
+            price_amount NUMERIC(12, 2) NOT NULL,
+            price_currency TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT current_timestamp
+        )
+        ''',
+        'CREATE INDEX invoice_pool_price_idx ON invoice_pool (price_amount, price_currency, created_at)',
+    ]),
+    (6, 'daily sales rollup for reports', [
+        '''
+        CREATE TABLE daily_sales (
+            day DATE NOT NULL,
+            currency TEXT NOT NULL,
+            created INTEGER NOT NULL,
+            finished INTEGER NOT NULL,
+            revenue NUMERIC(14, 2) NOT NULL,
+            problem_invoices INTEGER NOT NULL,
+            PRIMARY KEY (day, currency)
+        )
+        ''',
+        'CREATE INDEX transactions_payment_timestamp_idx ON transactions (payment_timestamp)',
+        'CREATE INDEX invoices_record_date_idx ON invoices (record_date)',
+    ]),
+    (7, 'order states and one ticket and operator invoice per order', [
+        'ALTER TABLE transactions ADD COLUMN state TEXT NOT NULL DEFAULT \'created\' '
+        'CHECK (state IN (\'created\', \'pending\', \'paid\', \'fulfilled\', \'failed\'))',
+        '''
+        UPDATE transactions SET state = CASE
+            WHEN is_use_for_ticket THEN 'fulfilled'
+            WHEN is_paid THEN 'paid'
+            WHEN payment_status IN ('failed', 'expired', 'refunded') THEN 'failed'
+            WHEN payment_status IS NOT NULL THEN 'pending'
+            ELSE 'created'
+        END
+        ''',
+        # Earlier races left duplicates behind, the first ticket and invoice of an order are kept
+        'DELETE FROM tickets AS t USING tickets AS d WHERE t.uuid = d.uuid AND t.ticket_id > d.ticket_id',
+        'DROP INDEX tickets_uuid_idx',
+        'CREATE UNIQUE INDEX tickets_uuid_key ON tickets (uuid)',
+        'DELETE FROM invoices AS i USING invoices AS d WHERE i.order_id = d.order_id AND i.id > d.id',
+        'DROP INDEX invoices_order_id_idx',
+        'CREATE UNIQUE INDEX invoices_order_id_key ON invoices (order_id)',
+    ]),
+    (8, 'support tickets, one open ticket per order', [
+        '''
+        CREATE TABLE support_tickets (
+            id SERIAL PRIMARY KEY,
+            order_id TEXT NOT NULL,
+            user_id bigint,
+            username TEXT,
+            reason TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'open' CHECK (state IN ('open', 'resolved', 'refunded')),
+            requests INTEGER NOT NULL DEFAULT 1,
+            operator_id TEXT,
+            notified_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT current_timestamp,
+            closed_by bigint,
+            closed_at TIMESTAMP
+        )
+        ''',
+        # Repeated help presses land on the open ticket of the order, a closed one may be followed by a new one
+        'CREATE UNIQUE INDEX support_tickets_open_order_key ON support_tickets (order_id) WHERE state = \'open\'',
+        # the digest job counts and assigns open tickets per operator
+        'CREATE INDEX support_tickets_open_operator_idx ON support_tickets (operator_id) WHERE state = \'open\'',
+    ]),
+    (9, 'invoice links of open orders for repeated checkouts', [
+        'ALTER TABLE transactions ADD COLUMN invoice_url TEXT',
+        # find_open_order: the unpaid order a user already holds for a product
+        'CREATE INDEX transactions_open_order_idx ON transactions (user_id, sku, payment_timestamp DESC) '
+        'WHERE state IN (\'created\', \'pending\') AND stock_released = FALSE',
+    ]),
+    (10, 'refunded order state', [
+        'ALTER TABLE transactions DROP CONSTRAINT transactions_state_check',
+        'ALTER TABLE transactions ADD CONSTRAINT transactions_state_check '
+        'CHECK (state IN (\'created\', \'pending\', \'paid\', \'fulfilled\', \'failed\', \'refunded\'))',
+    ]),
+]
+# Several bot processes may start at once, the advisory lock lets only one of them migrate
+MIGRATIONS_LOCK_ID = 7245001
+
+
+def run_migrations():
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATIONS_LOCK_ID,))
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                transaction_id SERIAL PRIMARY KEY,
-                uuid TEXT,
-                username TEXT,
-                is_paid BOOLEAN DEFAULT FALSE,
-                invoice_id TEXT,
-                is_use_for_ticket BOOLEAN DEFAULT FALSE,
-                payment_timestamp TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT current_timestamp
             )
         ''')
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cursor.fetchall()}
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+            logger.info(f'Apply migration {version}: {name}')
+
+
+run_migrations()
+
+
+# sku -> product and the skus in display order, swapped as a whole so readers never see a half-built index
+catalog_index = ({}, [])
+catalog_lock = threading.Lock()
+CATALOG_RELOAD_THRESHOLD = 100
+CATALOG_RECONNECT_DELAY = 5
+
+
+def product_from_row(row):
+    sku, title, price, currency, stock = row
+    return {'sku': sku, 'title': title, 'price': price, 'currency': currency, 'stock': stock,
+            'search_key': f'{sku} {title}'.casefold()}
+
+
+def sorted_skus(products):
+    return sorted(products, key=lambda sku: (products[sku]['title'].casefold(), sku))
+
+
+def load_catalog():
+    global catalog_index
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT sku, title, price, currency, stock FROM products WHERE is_active')
+        products = {row[0]: product_from_row(row) for row in cursor.fetchall()}
+    with catalog_lock:
+        catalog_index = (products, sorted_skus(products))
+    logger.info(f'In func load_catalog loaded {len(products)} products')
+
+
+def reload_products(skus):
+    global catalog_index
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT sku, title, price, currency, stock FROM products WHERE is_active AND sku IN %s',
+                       (tuple(skus),))
+        changed = {row[0]: product_from_row(row) for row in cursor.fetchall()}
+    with catalog_lock:
+        products, order = catalog_index
+        is_reordered = any(sku not in changed or sku not in products
+                           or changed[sku]['title'] != products[sku]['title'] for sku in skus)
+        products = dict(products)
+        for sku in skus:
+            products.pop(sku, None)
+        products.update(changed)
+        # Stock changes on every checkout keep the order, only new, removed or renamed products re-sort it
+        catalog_index = (products, sorted_skus(products) if is_reordered else order)
+
+
+def listen_for_catalog_changes(stop_event):
+    while not stop_event.is_set():
+        try:
+            connection = psycopg2.connect(dbname=f"{DB_NAME}", user=f"{USER_DB}", password=f"{PASS_DB}",
+                                          host=f"{HOST_DB}", port=f"{PORT_DB}")
+        except psycopg2.Error as e:
+            logger.error(f'In func listen_for_catalog_changes connect error: {e}')
+            stop_event.wait(CATALOG_RECONNECT_DELAY)
+            continue
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN products_changed')
+            # Changes made while no listener was connected are only seen by a full reload
+            load_catalog()
+            while not stop_event.is_set():
+                if not select.select([connection], [], [], CATALOG_RECONNECT_DELAY)[0]:
+                    continue
+                connection.poll()
+                skus = {notify.payload for notify in connection.notifies}
+                connection.notifies.clear()
+                if len(skus) > CATALOG_RELOAD_THRESHOLD:
+                    load_catalog()
+                elif skus:
+                    reload_products(skus)
+        except psycopg2.Error as e:
+            logger.error(f'In func listen_for_catalog_changes error: {e}')
+            stop_event.wait(CATALOG_RECONNECT_DELAY)
+        finally:
+            connection.close()
+
+
+def start_catalog_listener():
+    load_catalog()
+    stop_event = threading.Event()
+    threading.Thread(target=listen_for_catalog_changes, args=(stop_event,), name='catalog-listener',
+                     daemon=True).start()
+    return stop_event
+
+
+def search_products(text, limit):
+    needle = text.casefold()
+    products, order = catalog_index
+    found = []
+    for sku in order:
+        if needle in products[sku]['search_key']:
+            found.append(products[sku])
+            if len(found) == limit:
+                break
+    return found
+
+
+# Users already stored in the DB, their /start only touches last_interaction through the buffer.
+# Bounded like check_status_cache, a user dropped from it is upserted again on the next /start.
+known_users = {}
+last_interaction_buffer = {}
+last_interaction_lock = threading.Lock()
+
+
+def flush_last_interactions(context: CallbackContext = None):
+    with last_interaction_lock:
+        if not last_interaction_buffer:
+            return
+        pending = list(last_interaction_buffer.items())
+        last_interaction_buffer.clear()
+    try:
+        with get_connection() as conn, conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                'UPDATE users SET last_interaction = v.last_interaction, is_blocked = FALSE '
+                'FROM (VALUES %s) AS v(user_id, last_interaction) WHERE users.user_id = v.user_id',
+                pending, page_size=LAST_INTERACTION_FLUSH_SIZE
+            )
+        logger.info(f'In func flush_last_interactions saved {len(pending)} users')
+    except psycopg2.Error as e:
+        logger.error(f'In func flush_last_interactions error: {e}')
+        # Keep the entries for the next flush unless a newer touch already replaced them
+        with last_interaction_lock:
+            for user_id, last_interaction in pending:
+                last_interaction_buffer.setdefault(user_id, last_interaction)
 
-        logger.info('Table transactions create')
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                text TEXT,
-                path_to_photo TEXT,
-                path_to_video TEXT
-            )
-        ''')
-        logger.info('Table messages create')
+def touch_last_interaction(user_id):
+    with last_interaction_lock:
+        last_interaction_buffer[user_id] = datetime.now()
+        is_full = len(last_interaction_buffer) >= LAST_INTERACTION_FLUSH_SIZE
+    if is_full:
+        flush_last_interactions()
 
-        cursor.execute('''CREATE TABLE IF NOT EXISTS invoices
-                      (id SERIAL PRIMARY KEY, 
-                       order_id TEXT NOT NULL, 
-                       username TEXT NOT NULL, 
-                       record_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        conn.commit()
 
-        logger.info('Table invoices create')
+def remember_user(user_id):
+    with last_interaction_lock:
+        known_users[user_id] = None
+        while len(known_users) > KNOWN_USERS_CACHE_SIZE:
+            known_users.pop(next(iter(known_users)))
 
 
-def start(update):
+def start(update, context: CallbackContext):
     user = update.message.from_user
     username = user.username
     user_id = user.id
 
-    with conn:
-        with conn.cursor() as cursor:
-            cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
-            user_entry = cursor.fetchone()
-
-            if not user_entry:
+    if user_id in known_users:
+        touch_last_interaction(user_id)
+    else:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
                 cursor.execute(
-                    'INSERT INTO users (user_id, username, register_timestamp) VALUES (%s, %s, current_timestamp)',
+                    'INSERT INTO users (user_id, username, register_timestamp) VALUES (%s, %s, current_timestamp) '
+                    'ON CONFLICT (user_id) DO UPDATE SET last_interaction = current_timestamp, is_blocked = FALSE',
                     (user_id, username)
                 )
-                conn.commit()
-            else:
-                cursor.execute(
-                    'UPDATE users SET last_interaction = current_timestamp WHERE user_id = %s',
-                    (user_id,)
-                )
-                conn.commit()
+        remember_user(user_id)
 
+    update.message.reply_text(f'Hello, {username}!',
+                              reply_markup=START_KEYBOARD)
+
+
+def check_again_keyboard(order_id):
     keyboard = [
-        [InlineKeyboardButton("Buy_goods", callback_data='buy_ticket')],
-        [InlineKeyboardButton("Terms", callback_data='terms')]
+        [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
     ]
+    return InlineKeyboardMarkup(keyboard)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    update.message.reply_text(f'Hello, {username}!',
-                              reply_markup=reply_markup)
+def operator_keyboard(order_id):
+    keyboard = [
+        [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
+        [InlineKeyboardButton("Back", callback_data='back')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
 
 
-def button_click(update, context: CallbackContext):
+def back_keyboard(order_id):
+    return BACK_KEYBOARD
+
+
+def product_button(product):
+    sold_out = "" if product['stock'] > 0 else " (sold out)"
+    return [InlineKeyboardButton(f"{product['title']} - {product['price']} {product['currency']}{sold_out}",
+                                 callback_data=f"product_{product['sku']}")]
+
+
+def catalog_page(page):
+    products, order = catalog_index
+    page_size = settings.catalog_page_size
+    pages = max(1, -(-len(order) // page_size))
+    page = min(max(page, 0), pages - 1)
+    keyboard = [product_button(products[sku]) for sku in order[page * page_size:(page + 1) * page_size]]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=f'catalog_{page - 1}'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f'catalog_{page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='back')])
+    return f"Catalog, page {page + 1} of {pages}. Send /search <name> to find a product.", \
+        InlineKeyboardMarkup(keyboard)
+
+
+def handle_buy_ticket(update, context, argument):
     query = update.callback_query
-    user = query.from_user
-    username = user.username
-    query.answer()
-    button_id = query.data
+    # Without products in the catalog the bot keeps selling the single ticket at the configured price
+    if catalog_index[0]:
+        handle_catalog(update, context, '0')
+        return
+    order_id = str(uuid.uuid4())
+    logger.debug('Generate order_id = %s', order_id, extra={'user_id': query.from_user.id, 'order_id': order_id})
+    keyboard = [
+        [InlineKeyboardButton("🛒 Buy", callback_data=f'confirm_{order_id}')],
+        [InlineKeyboardButton("🔙 Back", callback_data='back')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    query.edit_message_text(text=f"The price is: {settings.price} usd.",
+                            reply_markup=reply_markup)
+
 
-    if button_id == 'buy_ticket':
-        logger.info(f'Username = {username} pressed the button {button_id}')
+def handle_catalog(update, context, page):
+    query = update.callback_query
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        page = 0
+    text, reply_markup = catalog_page(page)
+    query.edit_message_text(text=text, reply_markup=reply_markup)
+
+
+def handle_product(update, context, sku):
+    query = update.callback_query
+    product = catalog_index[0].get(sku)
+    if product is None:
+        query.edit_message_text(text="This product is no longer available.", reply_markup=TO_CATALOG_KEYBOARD)
+        return
+    keyboard = []
+    if product['stock'] > 0:
         order_id = str(uuid.uuid4())
-        logger.info(f'Generate order_id = {order_id}')
-        keyboard = [
-            [InlineKeyboardButton("🛒 Buy", callback_data=f'confirm_{order_id}')],
-            [InlineKeyboardButton("🔙 Back", callback_data='back')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(text=f"The price is: {PRICE} usd.",
-                                reply_markup=reply_markup)
-    elif button_id.startswith('confirm_'):
-        logger.info(f'Username = {username} pressed the button {button_id}')
-        order_id = button_id.split("_")[1]
-        payment = create_invoice(update, context, order_id)
-        logger.info(f'Create invoice = {payment}')
+        logger.debug('Generate order_id = %s for sku = %s', order_id, sku,
+                     extra={'user_id': query.from_user.id, 'order_id': order_id})
+        keyboard.append([InlineKeyboardButton("🛒 Buy", callback_data=f'confirm_{order_id}_{sku}')])
+    keyboard.append([InlineKeyboardButton("🔙 Catalog", callback_data='catalog_0')])
+    query.edit_message_text(text=f"{product['title']}\nThe price is: {product['price']} {product['currency']}.\n"
+                                 f"In stock: {product['stock']}",
+                            reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def search_catalog(update, context: CallbackContext):
+    text = ' '.join(context.args).strip()
+    if not text:
+        update.message.reply_text("Usage: /search <product name>")
+        return
+    page_size = settings.catalog_page_size
+    # One extra result tells whether the list was cut off
+    found = search_products(text, page_size + 1)
+    if not found:
+        update.message.reply_text(f"Nothing found for \"{text}\".", reply_markup=TO_CATALOG_KEYBOARD)
+        return
+    keyboard = [product_button(product) for product in found[:page_size]]
+    keyboard.append([InlineKeyboardButton("🔙 Catalog", callback_data='catalog_0')])
+    reply = "Found products:" if len(found) <= page_size else "First matches, refine the search to see more:"
+    update.message.reply_text(reply, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def handle_confirm(update, context, argument):
+    query = update.callback_query
+    # Catalog orders carry the sku after the order_id, the legacy single ticket has none
+    order_id, _, sku = argument.partition('_')
+    try:
+        payment = create_invoice(update, order_id, sku or None)
+        logger.debug('Create invoice = %s', payment, extra={'order_id': order_id})
         payment_link = payment["invoice_url"]
+        order_id = payment.get("order_id") or order_id
+    except OutOfStockError:
+        logger.info('In func handle_confirm sku = %s is sold out', sku, extra={'order_id': order_id})
+        query.edit_message_text(text="Sorry, this product is sold out.", reply_markup=TO_CATALOG_KEYBOARD)
+        return
+    except (requests.RequestException, KeyError, ValueError) as e:
+        logger.error(f'In func handle_confirm for order_id = {order_id} error: {e}')
         keyboard = [
-            [InlineKeyboardButton("Pay", url=f"{payment_link}")],
-            [InlineKeyboardButton("I Paid", callback_data=f'paid_{order_id}')],
-            [InlineKeyboardButton("Back", callback_data='back')]
+            [InlineKeyboardButton("🛒 Buy", callback_data=f'confirm_{argument}')],
+            [InlineKeyboardButton("🔙 Back", callback_data='back')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(text=f"Order {order_id} create."
-                                     f"Press button \"Pay\" to pay for order."
-                                     f"After payment click the button \"I paid\"",
+        query.edit_message_text(text="Temporary unavailability of payments. Please try again later.",
                                 reply_markup=reply_markup)
-    elif button_id.startswith("paid_"):
-        logger.info(f'Username = {username} pressed the button {button_id}')
-        order_id = button_id.split("_")[1]
-        keyboard = [
-            [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(text=f"Press \"Check transaction\", to verify a transaction {order_id}"
-                                , reply_markup=reply_markup)
-
-    elif button_id.startswith("check_"):
-        logger.info(f'Username = {username} pressed the button {button_id}')
-        order_id = button_id.split("_")[1]
-        if api_check():
-            transaction_in = is_transaction_in(update, context, order_id)
-            if is_transaction_in:
-                status = check_pay(update, context, transaction_in)
-                if status:
-                    if status == "finished":  # finished
-                        with conn:
-                            with conn.cursor() as cursor:
-                                cursor.execute(
-                                    'UPDATE transactions SET is_paid = TRUE, is_use_for_ticket = TRUE WHERE uuid = %s',
-                                    (order_id,)
-                                )
-                                logger.info(f'For order_id =  {order_id} change is_paid and is_use_for_ticket to TRUE')
-                                cursor.execute(
-                                    'INSERT INTO tickets (username, uuid, ticket_timestamp) VALUES (%s, %s, current_timestamp)',
-                                    (username, order_id)
-                                )
-                        keyboard = [
-                            [InlineKeyboardButton("Back to main menu", callback_data='back')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"Transaction successful!",
+        return
+    keyboard = [
+        [InlineKeyboardButton("Pay", url=f"{payment_link}")],
+        [InlineKeyboardButton("I Paid", callback_data=f'paid_{order_id}')],
+        [InlineKeyboardButton("Back", callback_data='back')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    query.edit_message_text(text=f"Order {order_id} create."
+                                 f"Press button \"Pay\" to pay for order."
+                                 f"After payment click the button \"I paid\"",
                             reply_markup=reply_markup)
 
-                    elif status == "waiting":  # waiting
-                        keyboard = [
-                            [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"Status is waiting. Press \"Check transaction\" to check transaction again {order_id}"
-                            , reply_markup=reply_markup)
-
-                    elif status == "confirming":
-                        keyboard = [
-                            [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"The transaction is processed on the blockchain. "
-                                 f"Press \"Check transaction\" to check transaction again {order_id}"
-                            , reply_markup=reply_markup)
-
-                    elif status == "confirmed":
-                        keyboard = [
-                            [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"The transaction is confirmed by the blockchain"
-                                 f".Press \"Check transaction\" to check transaction again {order_id}"
-                            , reply_markup=reply_markup)
-
-                    elif status == "sending":
-                        keyboard = [
-                            [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"Funds sent, please wait."
-                                 f" Press \"Check transaction\" to check transaction again {order_id}"
-                            , reply_markup=reply_markup)
-
-                    elif status == "partially_paid":
-                        add_invoice(order_id, username)
-                        keyboard = [
-                            [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
-                            [InlineKeyboardButton("Back", callback_data='back')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"The amount sent is less than required. Send an invoice to the operator"
-                            , reply_markup=reply_markup)
-
-                    elif status == "failed":
-                        add_invoice(order_id, username)
-                        keyboard = [
-                            [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
-                            [InlineKeyboardButton("Back", callback_data='back')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"Payment failed due to an error. Send an invoice to the operator"
-                            , reply_markup=reply_markup)
-
-                    elif status == "refunded":
-                        add_invoice(order_id, username)
-                        keyboard = [
-                            [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
-                            [InlineKeyboardButton("Back", callback_data='back')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"The funds have been returned to the user. Send an invoice to the operator"
-                            , reply_markup=reply_markup)
-
-                    elif status == "expired":
-                        keyboard = [
-                            [InlineKeyboardButton("Back", callback_data='back')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"Payment is overdue. Funds not sent within 7 days."
-                            , reply_markup=reply_markup)
-                    else:
-                        add_invoice(order_id, username)
-                        keyboard = [
-                            [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
-                            [InlineKeyboardButton("Back", callback_data='back')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        query.edit_message_text(
-                            text=f"Transaction {order_id} not found. Send an invoice to the operator"
-                            , reply_markup=reply_markup)
-                else:
-                    logger.info(f' For order_id = {order_id} and username = {username} '
-                                f'not found transaction if status:')
-                    add_invoice(order_id, username)
-                    keyboard = [
-                        [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
-                        [InlineKeyboardButton("Back", callback_data='back')]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    query.edit_message_text(
-                        text=f"Transaction {order_id} not found. Send an invoice to the operator"
-                        , reply_markup=reply_markup)
-            else:
-                logger.info(f'For order_id = {order_id} and username = {username} '
-                            f'not found transaction if is_transaction_in:')
-                add_invoice(order_id, username)
-                keyboard = [
-                    [InlineKeyboardButton("Send an invoice to the operator", callback_data=f'help_{order_id}')],
-                    [InlineKeyboardButton("Back", callback_data='back')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                query.edit_message_text(text=f"Transaction {order_id} not found. Send an invoice to the operator"
-                                        , reply_markup=reply_markup)
+
+def handle_paid(update, context, order_id):
+    query = update.callback_query
+    query.edit_message_text(text=f"Press \"Check transaction\", to verify a transaction {order_id}"
+                            , reply_markup=check_again_keyboard(order_id))
+
+
+# order_id -> (transaction_entry, status, expires_at), expires_at is None for terminal statuses
+check_status_cache = {}
+check_status_in_flight = {}
+check_status_lock = threading.Lock()
+check_status_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'cooldown': 0}
+last_check_presses = {}
+
+
+def fetch_order_status(order_id):
+    transaction_in = is_transaction_in(order_id)
+    # A ticket was already issued, pressing again only shows the success message
+    if not transaction_in and is_order_fulfilled(order_id):
+        return None, 'finished', True
+    status = stored_payment_status(transaction_in)
+    if transaction_in and not status:
+        try:
+            status = check_pay(transaction_in)
+        except requests.RequestException as e:
+            logger.info(f'In func fetch_order_status for order_id = {order_id} payment api unavailable: {e}')
+            return transaction_in, None, False
+        if status:
+            save_order_state(order_id, status)
+            if status in STOCK_RELEASE_STATUSES:
+                release_invoice_stock(transaction_in[0])
+    return transaction_in, status, True
+
+
+def lookup_order_status(order_id):
+    # Concurrent presses for the same order wait for one lookup instead of starting their own
+    with check_status_lock:
+        cached = check_status_cache.get(order_id)
+        if cached and (cached[2] is None or cached[2] > time.monotonic()):
+            check_status_stats['hits'] += 1
+            return cached[0], cached[1], True
+        future = check_status_in_flight.get(order_id)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            check_status_in_flight[order_id] = future
+            check_status_stats['misses'] += 1
         else:
-            logger.info(f'For order_id = {order_id} and username = {username} '
-                        f'api service unavailable, if api_check(): gave False')
-            keyboard = [
-                [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.edit_message_text(text=f"Temporary unavailability of transaction verification. Please wait."
-                                         f"Press \"Check transaction\" to check transaction again {order_id}"
-                                    , reply_markup=reply_markup)
-
-    elif button_id == 'back':
-        logger.info(f'Username = {username} pressed the button {button_id}')
-        keyboard = [
-            [InlineKeyboardButton("Buy", callback_data='buy_ticket')],
-            [InlineKeyboardButton("Terms", callback_data='terms')]
-        ]
+            check_status_stats['coalesced'] += 1
+    if not is_owner:
+        return future.result()
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        result = fetch_order_status(order_id)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with check_status_lock:
+            check_status_in_flight.pop(order_id, None)
+    transaction_in, status, api_available = result
+    if api_available:
+        with check_status_lock:
+            expires_at = None if status in TERMINAL_PAYMENT_STATUSES else time.monotonic() + settings.check_status_ttl
+            check_status_cache[order_id] = (transaction_in, status, expires_at)
+            while len(check_status_cache) > CHECK_CACHE_SIZE:
+                check_status_cache.pop(next(iter(check_status_cache)))
+    future.set_result(result)
+    return result
+
+
+def invalidate_order_status(order_id):
+    with check_status_lock:
+        check_status_cache.pop(order_id, None)
+
+
+def is_check_cooling_down(user_id, order_id):
+    with check_status_lock:
+        cached = check_status_cache.get(order_id)
+        if cached and cached[2] is None:
+            return False
+        now = time.monotonic()
+        last_press = last_check_presses.get((user_id, order_id))
+        if last_press is not None and now - last_press < settings.check_cooldown:
+            check_status_stats['cooldown'] += 1
+            return True
+        last_check_presses[(user_id, order_id)] = now
+        if len(last_check_presses) > CHECK_CACHE_SIZE:
+            last_check_presses.pop(next(iter(last_check_presses)))
+    return False
+
+
+def save_order_state(order_id, status):
+    # Written only when the status moves the order on, repeated checks of a waiting order change nothing
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE transactions SET state = {ORDER_STATE_TRANSITION.format(status="%(status)s")} '
+            'WHERE uuid = %(order_id)s AND is_use_for_ticket = FALSE '
+            f'AND state <> {ORDER_STATE_TRANSITION.format(status="%(status)s")}',
+            {'status': status, 'order_id': order_id}
+        )
 
-        query.edit_message_text(f'Hello, {username}!',
-                                reply_markup=reply_markup)
 
-    elif button_id.startswith('help_'):
-        logger.info(f'Username = {username} pressed the button {button_id}')
-        order_id = button_id.split("_")[1]
-        send_private_message(update, context, order_id)
-        logger.info(f'From username = {username} send message to the operator about order_id = {order_id}')
-        keyboard = [
-            [InlineKeyboardButton("Main menu", callback_data='back')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(text=f"Message sent to the operator! Wait for feedback."
-                                , reply_markup=reply_markup)
+def fulfill_order(order_id, username):
+    # Only an order with a paid invoice is fulfilled, a "finished" status alone doesn't override its state.
+    # A concurrent press waits for the row lock and then finds is_use_for_ticket already set, so exactly one
+    # of them moves the order to fulfilled and issues the ticket. The unique index on tickets.uuid backs this up.
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'UPDATE transactions SET is_paid = TRUE, is_use_for_ticket = TRUE, state = \'fulfilled\' '
+            'WHERE uuid = %(order_id)s AND is_use_for_ticket = FALSE AND state <> \'refunded\' '
+            'AND EXISTS (SELECT 1 FROM transactions AS paid WHERE paid.uuid = %(order_id)s AND paid.state = \'paid\')',
+            {'order_id': order_id}
+        )
+        if not cursor.rowcount:
+            return False
+        logger.info(f'For order_id =  {order_id} change is_paid and is_use_for_ticket to TRUE')
+        cursor.execute(
+            'INSERT INTO tickets (username, uuid, ticket_timestamp) VALUES (%s, %s, current_timestamp) '
+            'ON CONFLICT (uuid) DO NOTHING',
+            (username, order_id)
+        )
+        return bool(cursor.rowcount)
 
 
-    elif button_id == 'terms':
-        logger.info(f'Username = {username} pressed the button {button_id}')
-        keyboard = [
-            [InlineKeyboardButton("Main menu", callback_data='back')]
-        ]
+def handle_check(update, context, order_id):
+    query = update.callback_query
+    username = query.from_user.username
+    if is_check_cooling_down(query.from_user.id, order_id):
+        query.answer(text=f"Please wait {settings.check_cooldown} seconds before checking again")
+        return
+    query.answer()
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    transaction_in, status, api_available = lookup_order_status(order_id)
+    inc('bot_payment_status_total', source='check', status=status or ('unknown' if api_available else 'unavailable'))
+    if not api_available:
+        logger.info(f'For order_id = {order_id} and username = {username} api service unavailable')
+        query.edit_message_text(text=f"Temporary unavailability of transaction verification. Please wait."
+                                     f"Press \"Check transaction\" to check transaction again {order_id}"
+                                , reply_markup=check_again_keyboard(order_id))
+        return
 
-        query.edit_message_text(f'Hello, {username}!',
-                                reply_markup=reply_markup)
+    if status == "finished":
+        if fulfill_order(order_id, username) or is_order_fulfilled(order_id):
+            query.edit_message_text(text="Transaction successful!", reply_markup=FINISHED_KEYBOARD)
+            return
+        if is_order_refunded(order_id):
+            query.edit_message_text(text=ORDER_REFUNDED_REPLY.format(order_id=order_id), reply_markup=BACK_KEYBOARD)
+            return
+        # Paid but not fulfilled by this press nor by an earlier one, the next check asks again
+        invalidate_order_status(order_id)
+        logger.info('For order_id = %s and username = %s payment finished but order not fulfilled',
+                    order_id, username, extra={'user_id': query.from_user.id, 'order_id': order_id})
+        query.edit_message_text(text=f"Payment received, the order is still being processed. "
+                                     f"Press \"Check transaction\" to check transaction again {order_id}",
+                                reply_markup=check_again_keyboard(order_id))
+        return
+
+    if not transaction_in:
+        logger.info('For order_id = %s and username = %s not found transaction if is_transaction_in:',
+                    order_id, username, extra={'user_id': query.from_user.id, 'order_id': order_id})
+    elif not status:
+        logger.info('For order_id = %s and username = %s not found transaction if status:',
+                    order_id, username, extra={'user_id': query.from_user.id, 'order_id': order_id})
+    text, keyboard, send_to_operator = PAYMENT_STATUS_REPLIES.get(status, TRANSACTION_NOT_FOUND_REPLY)
+    if send_to_operator:
+        add_invoice(order_id, username)
+    query.edit_message_text(text=text.format(order_id=order_id), reply_markup=keyboard(order_id))
 
 
-def create_invoice(update: Update, order_id):
+def handle_back(update, context, argument):
     query = update.callback_query
-    user = query.from_user
-    username = user.username
+    query.edit_message_text(f'Hello, {query.from_user.username}!',
+                            reply_markup=MAIN_MENU_KEYBOARD)
+
+
+def handle_help(update, context, order_id):
+    query = update.callback_query
+    username = query.from_user.username
+    ticket_id, is_new = open_support_ticket(order_id, query.from_user.id, username)
+    logger.info('From username = %s support ticket %s about order_id = %s, new = %s', username, ticket_id, order_id,
+                is_new, extra={'user_id': query.from_user.id, 'order_id': order_id})
+    text = ("Message sent to the operator! Wait for feedback." if is_new
+            else "The operator already has your request. Wait for feedback.")
+    query.edit_message_text(text=text, reply_markup=TO_MAIN_MENU_KEYBOARD)
+
+
+def handle_support_action(update, context, ticket_id, state):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if not is_support_operator(user_id):
+        logger.info(f'In func handle_support_action user_id = {user_id} is no support operator')
+        query.answer(text="You don't have permissions for this action")
+        return
+    ticket = close_support_ticket(int(ticket_id), state, user_id) if ticket_id.isdigit() else None
+    if ticket is None:
+        query.answer(text=f"Ticket #{ticket_id} is already closed")
+    else:
+        query.answer(text=f"Ticket #{ticket_id} {state}")
+        notify_support_ticket_closed(context.bot, ticket, state)
+    # The digest keeps the buttons of the tickets that are still open
+    keyboard = [row for row in query.message.reply_markup.inline_keyboard
+                if row[0].callback_data != f'resolve_{ticket_id}']
+    query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def handle_resolve(update, context, ticket_id):
+    handle_support_action(update, context, ticket_id, 'resolved')
+
+
+def handle_refund(update, context, ticket_id):
+    handle_support_action(update, context, ticket_id, 'refunded')
+
+
+def handle_terms(update, context, argument):
+    query = update.callback_query
+    query.edit_message_text(f'Hello, {query.from_user.username}!',
+                            reply_markup=TO_MAIN_MENU_KEYBOARD)
+
+
+# Keyboards without per-order data are built once and shared by every reply
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Buy_goods", callback_data='buy_ticket')],
+    [InlineKeyboardButton("Terms", callback_data='terms')]
+])
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Buy", callback_data='buy_ticket')],
+    [InlineKeyboardButton("Terms", callback_data='terms')]
+])
+TO_MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Main menu", callback_data='back')]
+])
+FINISHED_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Back to main menu", callback_data='back')]
+])
+BACK_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Back", callback_data='back')]
+])
+TO_CATALOG_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Catalog", callback_data='catalog_0')]
+])
+
+# Payment status -> (reply text, keyboard for the order, whether the order is recorded for the operator)
+PAYMENT_STATUS_REPLIES = {
+    "waiting": ("Status is waiting. Press \"Check transaction\" to check transaction again {order_id}",
+                check_again_keyboard, False),
+    "confirming": ("The transaction is processed on the blockchain. "
+                   "Press \"Check transaction\" to check transaction again {order_id}",
+                   check_again_keyboard, False),
+    "confirmed": ("The transaction is confirmed by the blockchain"
+                  ".Press \"Check transaction\" to check transaction again {order_id}",
+                  check_again_keyboard, False),
+    "sending": ("Funds sent, please wait."
+                " Press \"Check transaction\" to check transaction again {order_id}",
+                check_again_keyboard, False),
+    "partially_paid": ("The amount sent is less than required. Send an invoice to the operator",
+                       operator_keyboard, True),
+    "failed": ("Payment failed due to an error. Send an invoice to the operator",
+               operator_keyboard, True),
+    "refunded": ("The funds have been returned to the user. Send an invoice to the operator",
+                 operator_keyboard, True),
+    "expired": ("Payment is overdue. Funds not sent within 7 days.",
+                back_keyboard, False),
+}
+ORDER_REFUNDED_REPLY = "The operator refunded order {order_id}, it will not be fulfilled."
+TRANSACTION_NOT_FOUND_REPLY = ("Transaction {order_id} not found. Send an invoice to the operator",
+                               operator_keyboard, True)
+
+# Handlers in this list answer the callback query themselves, e.g. with a cooldown notice
+SELF_ANSWERING_CALLBACKS = ('check', 'resolve', 'refund')
+
+# Callback data is either an exact key or "<prefix>_<argument>", mostly the order_id or a support ticket id
+CALLBACK_HANDLERS = {
+    'buy_ticket': handle_buy_ticket,
+    'catalog': handle_catalog,
+    'product': handle_product,
+    'confirm': handle_confirm,
+    'paid': handle_paid,
+    'check': handle_check,
+    'back': handle_back,
+    'help': handle_help,
+    'terms': handle_terms,
+    'resolve': handle_resolve,
+    'refund': handle_refund,
+}
+
+
+def button_click(update, context: CallbackContext):
+    query = update.callback_query
+    username = query.from_user.username
+    button_id = query.data
+
+    handler = CALLBACK_HANDLERS.get(button_id)
+    prefix, argument = button_id, None
+    if handler is None:
+        prefix, _, argument = button_id.partition('_')
+        handler = CALLBACK_HANDLERS.get(prefix)
+    if prefix not in SELF_ANSWERING_CALLBACKS:
+        query.answer()
+    if handler is None:
+        logger.info('Username = %s pressed unknown button %s', username, button_id,
+                    extra={'user_id': query.from_user.id})
+        return
+    logger.info('Username = %s pressed the button %s', username, button_id,
+                extra={'user_id': query.from_user.id, 'order_id': argument})
+    with traced(argument), timed('bot_handler_seconds', handler=f'button_click:{prefix}'):
+        handler(update, context, argument)
+
+
+class OutOfStockError(Exception):
+    pass
+
+
+def reserve_product(sku):
+    # Checking and decrementing the stock in one statement, concurrent checkouts can't both take the last unit
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'UPDATE products SET stock = stock - 1 WHERE sku = %s AND is_active AND stock > 0 '
+            'RETURNING title, price, currency',
+            (sku,)
+        )
+        product = cursor.fetchone()
+    if product is None:
+        raise OutOfStockError(sku)
+    return product
+
+
+def price_point(price_amount):
+    # The config price is a float, pooled invoices come back from NUMERIC(12, 2) columns as Decimal.
+    # Both have to compare equal for the pool to find the invoices it already holds.
+    return Decimal(str(price_amount)).quantize(Decimal('0.01'))
+
+
+def return_product(sku):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('UPDATE products SET stock = stock + 1 WHERE sku = %s', (sku,))
+
+
+def release_stock(condition, params):
+    # stock_released makes repeated callbacks and job runs return a unit only once
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'WITH released AS ('
+            'UPDATE transactions SET stock_released = TRUE '
+            f'WHERE {condition} AND sku IS NOT NULL AND stock_released = FALSE '
+            'AND (is_paid = FALSE OR state = \'refunded\') '
+            'RETURNING sku), '
+            'units AS (SELECT sku, count(*) AS units FROM released GROUP BY sku) '
+            'UPDATE products SET stock = products.stock + units.units '
+            'FROM units WHERE products.sku = units.sku RETURNING units.units',
+            params
+        )
+        return sum(units for units, in cursor.fetchall())
+
+
+def refund_order(order_id):
+    # Paid or not, an order that wasn't fulfilled yet never is after its refund, and its unit goes back on sale
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('UPDATE transactions SET state = \'refunded\' WHERE uuid = %s AND is_use_for_ticket = FALSE',
+                       (order_id,))
+        is_refunded = bool(cursor.rowcount)
+    if is_refunded:
+        release_stock('uuid = %s AND state = \'refunded\'', (order_id,))
+    return is_refunded
+
+
+def is_order_refunded(order_id):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM transactions WHERE uuid = %s AND state = \'refunded\' LIMIT 1', (order_id,))
+        return cursor.fetchone() is not None
+
+
+def release_invoice_stock(invoice_id):
+    if release_stock('invoice_id = %s', (invoice_id,)):
+        logger.info('In func release_invoice_stock returned stock of unpaid invoice', extra={'invoice_id': invoice_id})
+
+
+def release_expired_reservations(context: CallbackContext):
+    # Invoices nobody opened never get a payment status, their units come back once the invoice can't be paid
+    units = release_stock('payment_timestamp <= current_timestamp - make_interval(secs => %s)',
+                          (settings.invoice_lifetime,))
+    if units:
+        logger.info(f'In func release_expired_reservations returned {units} units of expired invoices')
+
+
+def find_open_order(user_id, sku):
+    # Updates of a user run one at a time, so a double tap on Buy sees the order the first tap created
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'SELECT invoice_id, uuid, invoice_url FROM transactions '
+            'WHERE user_id = %s AND sku IS NOT DISTINCT FROM %s AND state IN (\'created\', \'pending\') '
+            'AND stock_released = FALSE AND invoice_url IS NOT NULL '
+            'AND payment_timestamp > current_timestamp - make_interval(secs => %s) '
+            'ORDER BY payment_timestamp DESC LIMIT 1',
+            (user_id, sku, settings.invoice_lifetime)
+        )
+        return cursor.fetchone()
+
+
+def request_invoice(order_id, price_amount, price_currency, description):
     headers = {
         "x-api-key": f"{NOWPAYMENTS_API_KEY}"
     }
 
     payload = {
-        "price_amount": f"{PRICE}",
-        "price_currency": "usd",
+        "price_amount": f"{price_amount}",
+        "price_currency": price_currency,
         "order_id": order_id,
-        "order_description": "Ticket"
+        "order_description": description
     }
+    if settings.ipn_callback_url:
+        payload["ipn_callback_url"] = settings.ipn_callback_url
 
-    response = requests.post(f"{BASE_URL}/v1/invoice", json=payload, headers=headers)
-    logger.info(f'username = {username} create invoice =  {response}')
+    response = payments_request("POST", "/v1/invoice", json=payload, headers=headers)
+    logger.debug('Create invoice = %s', response, extra={'order_id': order_id})
     data = response.json()
-    logger.info(f'username = {username} data = {data}')
-    with conn:
-        with conn.cursor() as cursor:
+    logger.debug('Invoice data = %s', data, extra={'order_id': order_id})
+    return data
+
+
+def take_pooled_invoice(username, user_id, sku, price_amount, price_currency):
+    # SKIP LOCKED lets concurrent checkouts take different invoices instead of waiting for each other
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM invoice_pool WHERE id = ('
+            'SELECT id FROM invoice_pool WHERE price_amount = %s AND price_currency = %s '
+            'AND created_at > current_timestamp - make_interval(secs => %s) '
+            'ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED) '
+            'RETURNING invoice_id, order_id, invoice_url, created_at',
+            (price_amount, price_currency, settings.invoice_pool_max_age)
+        )
+        pooled = cursor.fetchone()
+        if pooled is not None:
+            # The invoice expires invoice_lifetime after NOWPayments created it, not after it left the pool
+            invoice_id, order_id, invoice_url, created_at = pooled
             cursor.execute(
-                'INSERT INTO transactions (uuid, username, invoice_id, payment_timestamp) VALUES (%s, %s, %s, '
-                'current_timestamp)',
-                (order_id, username, data["id"])
+                'INSERT INTO transactions (uuid, username, user_id, invoice_id, invoice_url, payment_timestamp, '
+                'sku, price_amount, price_currency) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                (order_id, username, user_id, invoice_id, invoice_url, created_at, sku, price_amount, price_currency)
             )
-            logger.info(f'For username = {username} issued order_id = {order_id} and invoice_id = {data["id"]}')
+    inc('bot_invoice_pool_total', result='hit' if pooled else 'miss')
+    if pooled is None:
+        return None
+    logger.info('For username = %s issued pooled order_id = %s and invoice_id = %s', username, order_id, invoice_id,
+                extra={'user_id': user_id, 'order_id': order_id, 'invoice_id': invoice_id})
+    return {"id": invoice_id, "order_id": order_id, "invoice_url": invoice_url}
 
+
+def create_invoice(update: Update, order_id, sku=None):
+    query = update.callback_query
+    user = query.from_user
+    username = user.username
+    user_id = user.id
+
+    # Pressing Buy again, also on a new order for the same product, hands out the invoice the user already holds
+    open_order = find_open_order(user_id, sku)
+    if open_order:
+        invoice_id, order_id, invoice_url = open_order
+        logger.info('For username = %s reuse order_id = %s and invoice_id = %s', username, order_id, invoice_id,
+                    extra={'user_id': user_id, 'order_id': order_id, 'invoice_id': invoice_id})
+        return {"id": invoice_id, "order_id": order_id, "invoice_url": invoice_url}
+    if sku:
+        # The unit is held from here on, so the invoice can't be issued for stock that is already sold
+        description, price_amount, price_currency = reserve_product(sku)
+    else:
+        description, price_amount, price_currency = "Ticket", settings.price, "usd"
+    price_amount = price_point(price_amount)
+    try:
+        # A pooled invoice was created with its own order_id, the caller continues with the returned one
+        data = INVOICE_POOL_ENABLED and take_pooled_invoice(username, user_id, sku, price_amount, price_currency)
+        if data:
+            return data
+        data = request_invoice(order_id, price_amount, price_currency, description)
+        invoice_id = data["id"]
+        # Until this row exists nothing refers to the held unit, so a failed insert returns it as well
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO transactions (uuid, username, user_id, invoice_id, invoice_url, payment_timestamp, '
+                'sku, price_amount, price_currency) '
+                'VALUES (%s, %s, %s, %s, %s, current_timestamp, %s, %s, %s)',
+                (order_id, username, user_id, invoice_id, data["invoice_url"], sku, price_amount, price_currency)
+            )
+    except (requests.RequestException, psycopg2.Error, KeyError, ValueError):
+        if sku:
+            return_product(sku)
+        raise
+    logger.info('For username = %s issued order_id = %s and invoice_id = %s', username, order_id, invoice_id,
+                extra={'user_id': user_id, 'order_id': order_id, 'invoice_id': invoice_id})
     return data
 
 
+# Every webhook peer runs the refill job, the advisory lock keeps them from filling the same gap twice
+INVOICE_POOL_LOCK_ID = 7245004
+
+
+def invoice_pool_price_points():
+    products, _ = catalog_index
+    if not products:
+        return {(price_point(settings.price), "usd")}
+    return {(price_point(product['price']), product['currency'])
+            for product in products.values() if product['stock'] > 0}
+
+
+def fill_invoice_pool_entry(price_amount, price_currency):
+    order_id = str(uuid.uuid4())
+    data = request_invoice(order_id, price_amount, price_currency, "Order")
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO invoice_pool (invoice_id, order_id, invoice_url, price_amount, price_currency) '
+            'VALUES (%s, %s, %s, %s, %s)',
+            (str(data["id"]), order_id, data["invoice_url"], price_amount, price_currency)
+        )
+
+
+def refill_invoice_pool(context: CallbackContext):
+    with job_lock(INVOICE_POOL_LOCK_ID) as is_locked:
+        if is_locked:
+            fill_invoice_pool()
+
+
+def fill_invoice_pool():
+    # Invoices close to expiry are dropped, the refill below replaces them with fresh ones
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('DELETE FROM invoice_pool WHERE created_at <= current_timestamp - make_interval(secs => %s)',
+                       (settings.invoice_pool_max_age,))
+        expired = cursor.rowcount
+        cursor.execute('SELECT price_amount, price_currency, count(*) FROM invoice_pool '
+                       'GROUP BY price_amount, price_currency')
+        pooled = {(price_amount, price_currency): count for price_amount, price_currency, count in cursor.fetchall()}
+    missing = [price_point for price_point in invoice_pool_price_points()
+               for _ in range(INVOICE_POOL_SIZE - pooled.get(price_point, 0))]
+    futures = [payments_executor.submit(fill_invoice_pool_entry, *price_point) for price_point in missing]
+    created = 0
+    for future in futures:
+        try:
+            future.result()
+            created += 1
+        except (requests.RequestException, psycopg2.Error, KeyError, ValueError) as e:
+            logger.error(f'In func fill_invoice_pool error: {e}')
+    if expired or missing:
+        logger.info(f'In func fill_invoice_pool dropped {expired} expired, created {created} of {len(missing)}')
+
+
 def is_transaction_in(order_id):
-    with conn.cursor() as cursor:
+    with get_connection() as conn, conn.cursor() as cursor:
         cursor.execute(
-            'SELECT invoice_id FROM transactions WHERE uuid = %s AND is_use_for_ticket = FALSE ORDER BY payment_timestamp DESC LIMIT 1',
-            (order_id,)
+            'SELECT invoice_id, payment_status, '
+            'payment_timestamp > current_timestamp - make_interval(secs => %s) AS is_payable '
+            'FROM transactions WHERE uuid = %s AND is_use_for_ticket = FALSE '
+            'ORDER BY payment_timestamp DESC LIMIT 1',
+            (settings.invoice_lifetime, order_id)
         )
         transaction_entry = cursor.fetchone()
-        logger.info(
-            f'In func is_transaction_in for order_id = {order_id}, invoice_id = {transaction_entry} where '
-            f'is_use_for_ticket = FALSE')
+        logger.debug('In func is_transaction_in for order_id = %s, transaction = %s where is_use_for_ticket = FALSE',
+                     order_id, transaction_entry, extra={'order_id': order_id})
 
     return transaction_entry
 
 
+def is_order_fulfilled(order_id):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM transactions WHERE uuid = %s AND state = \'fulfilled\' LIMIT 1', (order_id,))
+        return cursor.fetchone() is not None
+
+
+def stored_payment_status(transaction_entry):
+    if not transaction_entry:
+        return None
+    if RECONCILE_ENABLED:
+        # Every payable invoice is polled in the background, no stored status means nothing was paid yet.
+        # Past its lifetime the reconciler stops, then the check asks the API once more for a final answer.
+        return transaction_entry[1] or ('waiting' if transaction_entry[2] else None)
+    if IPN_ENABLED:
+        return transaction_entry[1]
+    return None
+
+
 def check_pay(transaction_entry):
     invoice_id = transaction_entry[0]
-    logger.info(
-        f'In func check_pay for transaction_entry = {transaction_entry}, invoice_id = {invoice_id}')
+    logger.debug('In func check_pay for transaction_entry = %s', transaction_entry, extra={'invoice_id': invoice_id})
     status = None
     try:
         status = check_payment_by_payment_id(list_of_payments(invoice_id))
-        logger.info(
-            f'In func check_pay status = {status} for invoice_id = {invoice_id}')
+        logger.debug('In func check_pay status = %s', status, extra={'invoice_id': invoice_id})
+    except requests.RequestException:
+        raise
     except Exception as e:
         logger.error(f'In func check_pay for invoice_id = {invoice_id} error: {e}')
     return status
 
 
-def api_check():
-    response = requests.get(f"{BASE_URL}/v1/status")
-    logger.info(f'In func api_check response = {response}')
-
-    data = response.json()
-    return data["message"] == 'OK'
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+def payments_circuit_allows_request():
+    # Returns whether the call may be sent and, for a probe, the opening it probes (opened_at), so its result
+    # is told apart from calls that were sent before the circuit opened and only end now
+    with payments_circuit_lock:
+        if payments_circuit['state'] == 'open':
+            if time.monotonic() - payments_circuit['opened_at'] < settings.circuit_reset_timeout:
+                return False, None
+            payments_circuit['state'] = 'half_open'
+            payments_circuit['probes'] = 0
+            logger.info('Payments circuit half-open, sending probe requests')
+        if payments_circuit['state'] == 'half_open':
+            if payments_circuit['probes'] >= settings.circuit_half_open_probes:
+                return False, None
+            payments_circuit['probes'] += 1
+            return True, payments_circuit['opened_at']
+        return True, None
+
+
+def record_payments_result(is_success, probe_of=None):
+    with payments_circuit_lock:
+        if payments_circuit['state'] == 'half_open':
+            if probe_of != payments_circuit['opened_at']:
+                # Sent before this half-open period, only its own probes decide whether the API is back
+                return
+            payments_circuit['probes'] -= 1
+            if is_success:
+                payments_circuit['state'] = 'closed'
+                payments_circuit_results.clear()
+                logger.info('Payments circuit closed')
+            else:
+                payments_circuit['state'] = 'open'
+                payments_circuit['opened_at'] = time.monotonic()
+                logger.info('Payments circuit re-opened after failed probe')
+            return
+        payments_circuit_results.append(is_success)
+        failures = payments_circuit_results.count(False)
+        if (payments_circuit['state'] == 'closed' and len(payments_circuit_results) >= settings.circuit_min_calls
+                and failures / len(payments_circuit_results) >= settings.circuit_failure_rate):
+            payments_circuit['state'] = 'open'
+            payments_circuit['opened_at'] = time.monotonic()
+            logger.error(f'Payments circuit opened: {failures} of last {len(payments_circuit_results)} calls failed')
+
+
+def payments_request(method, path, **kwargs):
+    # While the circuit is open calls fail at once instead of waiting for a timeout
+    is_allowed, probe_of = payments_circuit_allows_request()
+    if not is_allowed:
+        raise CircuitOpenError(f'Payments circuit is open, {method} {path} not sent')
+    started = time.monotonic()
+    metric_path = re.sub(r'^/v1/payment/[^/]+$', '/v1/payment/{id}', path)
+    try:
+        response = payments_session.request(method, f"{BASE_URL}{path}", timeout=settings.payments_timeout, **kwargs)
+    except requests.RequestException:
+        record_payments_result(False, probe_of)
+        observe('bot_http_request_seconds', time.monotonic() - started, target='nowpayments', path=metric_path)
+        inc('bot_http_errors_total', target='nowpayments', path=metric_path)
+        raise
+    observe('bot_http_request_seconds', time.monotonic() - started, target='nowpayments', path=metric_path)
+    record_payments_result(response.status_code < 500, probe_of)
+    return response
 
 
 def auth():
@@ -479,31 +1746,73 @@ def auth():
         "email": f"{LOGIN_PAYMENTS}",
         "password": f"{PASS_PAYMENTS}"
     }
-    response = requests.post(f"{BASE_URL}/v1/auth", json=body)
-    data = response.json()
     token = None
     try:
+        response = payments_request("POST", "/v1/auth", json=body)
+        data = response.json()
         token = data["token"]
-        logger.info(f'In func auth token successfully return')
+        logger.debug('In func auth token successfully return')
     except Exception as e:
         logger.error(f'In func auth error: {e}')
     return token
 
 
-def list_of_payments(invoice_id):
-    token = auth()
-
+def token_expires_at(token):
+    # The JWT payload carries "exp", fall back to the configured lifetime if it can't be read
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        expires_in = json.loads(base64.urlsafe_b64decode(payload))['exp'] - time.time()
+    except (IndexError, KeyError, TypeError, ValueError):
+        expires_in = settings.auth_token_ttl
+    return time.monotonic() + expires_in
+
+
+def is_auth_token_fresh(stale_token=None):
+    token = auth_token_cache['token']
+    return (token is not None and token != stale_token
+            and time.monotonic() < auth_token_cache['expires_at'] - settings.auth_token_refresh_margin)
+
+
+def get_auth_token(stale_token=None):
+    if is_auth_token_fresh(stale_token):
+        auth_token_stats['hits'] += 1
+        return auth_token_cache['token']
+
+    # Only one thread logs in, the others wait on the lock and reuse its token
+    with auth_token_lock:
+        if is_auth_token_fresh(stale_token):
+            auth_token_stats['hits'] += 1
+            return auth_token_cache['token']
+        auth_token_stats['misses'] += 1
+        token = auth()
+        if token:
+            auth_token_cache['token'] = token
+            auth_token_cache['expires_at'] = token_expires_at(token)
+            logger.info(f'In func get_auth_token token refreshed, stats = {auth_token_stats}')
+        return token
+
+
+def get_payments(token, params):
     headers = {
         "x-api-key": f"{NOWPAYMENTS_API_KEY}",
         "Authorization": f"Bearer {token}"
     }
-    response = requests.get(f"{BASE_URL}/v1/payment/?invoiceId={invoice_id}"
-                            , headers=headers)
-    json_response = response.json()
+    response = payments_request("GET", "/v1/payment/", params=params, headers=headers)
+    if response.status_code == 401:
+        logger.info(f'In func get_payments for params = {params} token rejected, re-auth')
+        auth_token_stats['refresh_on_401'] += 1
+        headers["Authorization"] = f"Bearer {get_auth_token(stale_token=token)}"
+        response = payments_request("GET", "/v1/payment/", params=params, headers=headers)
+    return response.json()
+
+
+def list_of_payments(invoice_id):
+    json_response = get_payments(get_auth_token(), {"invoiceId": invoice_id})
     payment_id = None
     try:
         payment_id = json_response['data'][0]['payment_id']
-        logger.info(f'In func list_of_payments for invoice_id = {invoice_id} payment_id = {payment_id}')
+        logger.debug('In func list_of_payments payment_id = %s', payment_id, extra={'invoice_id': invoice_id})
     except Exception as e:
         logger.error(f'In func list_of_payments for invoice_id = {invoice_id} error: {e}')
     return payment_id
@@ -513,30 +1822,20 @@ def check_payment_by_payment_id(payment_id):
     headers = {
         "x-api-key": f"{NOWPAYMENTS_API_KEY}"
     }
-    response = requests.get(f"{BASE_URL}/v1/payment/{payment_id}"
-                            , headers=headers)
+    response = payments_request("GET", f"/v1/payment/{payment_id}", headers=headers)
     data = response.json()
     payment_status = None
     try:
         payment_status = data["payment_status"]
-        logger.info(
-            f'in func check_payment_by_payment_id for payment_id = {payment_id} payment_status = {payment_status}')
+        logger.debug('In func check_payment_by_payment_id for payment_id = %s payment_status = %s',
+                     payment_id, payment_status)
     except Exception as e:
         logger.error(f'In func check_payment_by_payment_id for payment_id = {payment_id} error: {e}')
     return payment_status
 
 
-def send_private_message(update: Update, context: CallbackContext, order_id) -> None:
-    try:
-        context.bot.send_message(chat_id=f'{HELP_USER_ID}', text=f"Someone have issues with {order_id}")
-        logger.info(
-            f'In func send_private_message for order_id = {order_id} send message for operator')
-    except Exception as e:
-        logger.error(f'In func send_private_message for order_id = {order_id} error: {e}')
-
-
 def get_last_message():
-    with conn.cursor() as cursor:
+    with get_connection() as conn, conn.cursor() as cursor:
         cursor.execute("SELECT * FROM messages ORDER BY id DESC LIMIT 1")
         message = cursor.fetchone()
         if not message:
@@ -545,58 +1844,1137 @@ def get_last_message():
     return dict(zip(columns, message))
 
 
-def get_all_users():
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT user_id FROM users")
-        users = cursor.fetchall()
-    return [user[0] for user in users]
+def get_all_users(after_user_id=0, itersize=USERS_ITERSIZE):
+    # Server-side cursor: rows arrive itersize at a time instead of the whole table at once. The connection
+    # and its pool slot stay taken until the generator is exhausted or closed, so it is meant for one-shot
+    # reads like the users export. The broadcast waits on Telegram between users and reads iter_user_chunks.
+    with get_connection() as conn, conn.cursor(name='all_users') as cursor:
+        cursor.itersize = itersize
+        cursor.execute("SELECT user_id FROM users WHERE user_id > %s AND is_blocked IS NOT TRUE "
+                       "ORDER BY user_id", (after_user_id,))
+        for user in cursor:
+            yield user[0]
+
+
+def get_users_page(after_user_id, limit):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT user_id FROM users WHERE user_id > %s AND is_blocked IS NOT TRUE "
+                       "ORDER BY user_id LIMIT %s", (after_user_id, limit))
+        return [user[0] for user in cursor.fetchall()]
+
+
+def iter_user_chunks(after_user_id=0, chunk_size=USERS_ITERSIZE):
+    # Keyset pagination by user_id: every chunk is a short query, so a long consumer holds no connection
+    # and can resume from the last user_id it finished
+    while True:
+        users = get_users_page(after_user_id, chunk_size)
+        if not users:
+            return
+        yield users
+        after_user_id = users[-1]
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Telegram's RetryAfter applies to the whole bot, so every sender waits it out
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+
+broadcast_limiter = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+broadcast_lock = threading.Lock()
+
+
+def save_media_file_id(message, column, file_id):
+    message[column] = file_id
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(sql.SQL('UPDATE messages SET {} = %s WHERE id = %s').format(sql.Identifier(column)),
+                       (file_id, message["id"]))
+    logger.info(f'In func save_media_file_id for message id = {message["id"]} saved {column}')
+
+
+def send_broadcast_photo(bot, chat_id, message):
+    # After the first upload Telegram keeps the file, later sends only reference its file_id
+    if message.get("photo_file_id"):
+        return bot.send_photo(chat_id=chat_id, photo=message["photo_file_id"])
+    with open(message["path_to_photo"], "rb") as photo:
+        sent = bot.send_photo(chat_id=chat_id, photo=photo)
+    save_media_file_id(message, "photo_file_id", sent.photo[-1].file_id)
+    return sent
+
+
+def send_broadcast_video(bot, chat_id, message):
+    if message.get("video_file_id"):
+        return bot.send_video(chat_id=chat_id, video=message["video_file_id"])
+    with open(message["path_to_video"], "rb") as video:
+        sent = bot.send_video(chat_id=chat_id, video=video)
+    save_media_file_id(message, "video_file_id", sent.video.file_id)
+    return sent
+
+
+def preupload_media(bot, chat_id, message):
+    # Uploads media missing a file_id once, so the concurrent senders never upload the file themselves
+    if message.get("path_to_photo") and not message.get("photo_file_id"):
+        send_broadcast_photo(bot, chat_id, message)
+    if message.get("path_to_video") and not message.get("video_file_id"):
+        send_broadcast_video(bot, chat_id, message)
+
+
+def send_broadcast_part(bot, user_id, part, message):
+    broadcast_limiter.acquire()
+    if part == "text":
+        bot.send_message(chat_id=user_id, text=message["text"])
+    elif part == "path_to_photo":
+        send_broadcast_photo(bot, user_id, message)
+    elif part == "path_to_video":
+        send_broadcast_video(bot, user_id, message)
+
+
+def deliver_broadcast(bot, user_id, message):
+    with timed('bot_broadcast_delivery_seconds'):
+        result = deliver_broadcast_parts(bot, user_id, message)
+    inc('bot_broadcast_deliveries_total', result=result)
+    return result
+
+
+def deliver_broadcast_parts(bot, user_id, message):
+    for part in ("text", "path_to_photo", "path_to_video"):
+        if not message.get(part):
+            continue
+        for attempt in range(settings.broadcast_retries + 1):
+            try:
+                send_broadcast_part(bot, user_id, part, message)
+                break
+            except RetryAfter as e:
+                logger.info(f'In func deliver_broadcast for user_id = {user_id} flood limit, retry after {e.retry_after}')
+                broadcast_limiter.pause(e.retry_after)
+            except Unauthorized:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logger.error(f'In func deliver_broadcast for user_id = {user_id} error: {e}')
+                return "failed"
+            except NetworkError as e:
+                logger.info(f'In func deliver_broadcast for user_id = {user_id} attempt {attempt} error: {e}')
+                time.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.error(f'In func deliver_broadcast for user_id = {user_id} error: {e}')
+                return "failed"
+        else:
+            return "failed"
+    return "sent"
+
+
+def start_or_resume_broadcast(message_id):
+    # An unfinished broadcast of the same message continues from its checkpoint
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT id, last_user_id, sent, failed, blocked FROM broadcasts '
+                       'WHERE message_id = %s AND finished_at IS NULL ORDER BY id DESC LIMIT 1', (message_id,))
+        broadcast = cursor.fetchone()
+        if not broadcast:
+            cursor.execute('INSERT INTO broadcasts (message_id) VALUES (%s) '
+                           'RETURNING id, last_user_id, sent, failed, blocked', (message_id,))
+            broadcast = cursor.fetchone()
+    return broadcast
+
+
+def save_broadcast_progress(broadcast_id, last_user_id, stats, blocked_users, finished=False):
+    with get_connection() as conn, conn.cursor() as cursor:
+        if blocked_users:
+            cursor.execute('UPDATE users SET is_blocked = TRUE WHERE user_id = ANY(%s)', (blocked_users,))
+        cursor.execute('UPDATE broadcasts SET last_user_id = %s, sent = %s, failed = %s, blocked = %s, '
+                       'finished_at = CASE WHEN %s THEN current_timestamp END WHERE id = %s',
+                       (last_user_id, stats["sent"], stats["failed"], stats["blocked"], finished, broadcast_id))
+
+
+def count_active_users(after_user_id=0):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM users WHERE user_id > %s AND is_blocked IS NOT TRUE', (after_user_id,))
+        return cursor.fetchone()[0]
+
+
+def report_broadcast_progress(bot, chat_id, report_message_id, broadcast_id, stats, total, started, finished=False):
+    processed = stats["sent"] + stats["failed"] + stats["blocked"]
+    elapsed = max(time.monotonic() - started, 0.001)
+    text = (f"Broadcast {broadcast_id} {'finished' if finished else 'in progress'}: "
+            f"{processed}/{total} users, sent {stats['sent']}, blocked {stats['blocked']}, "
+            f"failed {stats['failed']}, {stats['session'] / elapsed:.1f} users/s")
+    try:
+        bot.edit_message_text(chat_id=chat_id, message_id=report_message_id, text=text)
+    except TelegramError as e:
+        logger.info(f'In func report_broadcast_progress for broadcast_id = {broadcast_id} error: {e}')
+
+
+def run_broadcast(bot, admin_chat_id, message):
+    try:
+        broadcast_id, last_user_id, sent, failed, blocked = start_or_resume_broadcast(message["id"])
+        stats = {"sent": sent, "failed": failed, "blocked": blocked, "session": 0}
+        total = sent + failed + blocked + count_active_users(last_user_id)
+        logger.info(f'In func run_broadcast broadcast_id = {broadcast_id} start after user_id = {last_user_id}')
+        preupload_media(bot, admin_chat_id, message)
+        report = bot.send_message(chat_id=admin_chat_id, text=f"Broadcast {broadcast_id} started")
+        started = last_report = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix='broadcast') as senders:
+            for users in iter_user_chunks(last_user_id, BROADCAST_CHUNK_SIZE):
+                results = list(senders.map(lambda user: deliver_broadcast(bot, user, message), users))
+                for result in results:
+                    stats[result] += 1
+                stats["session"] += len(users)
+                last_user_id = users[-1]
+                # The checkpoint moves only after the whole chunk is done, so a restart never skips anyone
+                save_broadcast_progress(broadcast_id, last_user_id, stats,
+                                        [user for user, result in zip(users, results) if result == "blocked"])
+                if time.monotonic() - last_report >= settings.broadcast_progress_interval:
+                    last_report = time.monotonic()
+                    report_broadcast_progress(bot, admin_chat_id, report.message_id, broadcast_id, stats, total,
+                                              started)
+
+        save_broadcast_progress(broadcast_id, last_user_id, stats, [], finished=True)
+        report_broadcast_progress(bot, admin_chat_id, report.message_id, broadcast_id, stats, total, started,
+                                  finished=True)
+        logger.info(f'In func run_broadcast broadcast_id = {broadcast_id} finished: {stats}')
+    except Exception as e:
+        logger.error(f'In func run_broadcast error: {e}')
+    finally:
+        broadcast_lock.release()
 
 
 def send_message_to_all(update, context):
     user_id = update.message.from_user.id
-    if user_id not in ADMINS:
+    if user_id not in settings.admins:
         logger.info(
             f'In func send_message_to_all user_id = {user_id}. {user_id} don\'t have permissions for this command!')
         update.message.reply_text("You don't have permissions for this command")
         return
     message = get_last_message()
-    all_users = get_all_users()
-
-    for user in all_users:
-
-        if message.get("text"):
-            context.bot.send_message(chat_id=user, text=message.get("text"))
+    if not message:
+        update.message.reply_text("There is no message to send")
+        return
+    if not broadcast_lock.acquire(blocking=False):
+        update.message.reply_text("A broadcast is already running")
+        return
+    threading.Thread(target=run_broadcast, args=(context.bot, update.message.chat_id, message),
+                     name='broadcast', daemon=True).start()
 
-        if message.get("path_to_photo"):
-            with open(message["path_to_photo"], "rb") as photo:
-                context.bot.send_photo(chat_id=user, photo=photo)
 
-        if message.get("path_to_video"):
-            with open(message["path_to_video"], "rb") as video:
-                context.bot.send_video(chat_id=user, video=video)
+def preupload_broadcast_media(update, context):
+    user_id = update.message.from_user.id
+    if user_id not in settings.admins:
+        logger.info(
+            f'In func preupload_broadcast_media user_id = {user_id}. {user_id} don\'t have permissions for this command!')
+        update.message.reply_text("You don't have permissions for this command")
+        return
+    message = get_last_message()
+    if not message.get("path_to_photo") and not message.get("path_to_video"):
+        update.message.reply_text("The last message has no media")
+        return
+    try:
+        preupload_media(context.bot, update.message.chat_id, message)
+    except (OSError, TelegramError) as e:
+        logger.error(f'In func preupload_broadcast_media for message id = {message["id"]} error: {e}')
+        update.message.reply_text(f"Media upload failed: {e}")
+        return
+    update.message.reply_text("Media uploaded, the broadcast will reuse it")
 
 
 def add_invoice(order_id, username):
-    with conn.cursor() as cursor:
-        cursor.execute('INSERT INTO invoices (order_id, username) VALUES (%s, %s)',
+    # Every failed check lands here, the operator needs the order only once
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('INSERT INTO invoices (order_id, username) VALUES (%s, %s) ON CONFLICT (order_id) DO NOTHING',
                        (order_id, username))
-        conn.commit()
 
 
-def main():
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
+# Operator messages are few but must not add to a flood limit the bot already hit
+support_limiter = TokenBucket(SUPPORT_NOTIFY_RATE, max(SUPPORT_NOTIFY_RATE, 1))
+# Every webhook peer runs the digest job, the advisory lock lets only one of them send it
+SUPPORT_DIGEST_LOCK_ID = 7245002
+
+
+def support_operators():
+    operators = settings.support_operators or [settings.help_user_id]
+    return [str(operator) for operator in operators if str(operator)]
+
+
+def is_support_operator(user_id):
+    return str(user_id) in support_operators() or user_id in settings.admins
+
+
+def open_support_ticket(order_id, user_id, username):
+    # Presses for an order with an open ticket only count as another request, the operator hears of it once
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO support_tickets (order_id, user_id, username, reason) '
+            'SELECT %(order_id)s, %(user_id)s, %(username)s, '
+            'COALESCE((SELECT payment_status FROM transactions WHERE uuid = %(order_id)s '
+            'ORDER BY payment_timestamp DESC NULLS LAST LIMIT 1), \'not found\') '
+            'ON CONFLICT (order_id) WHERE state = \'open\' '
+            'DO UPDATE SET requests = support_tickets.requests + 1 '
+            'RETURNING id, xmax = 0',
+            {'order_id': order_id, 'user_id': user_id, 'username': username}
+        )
+        ticket_id, is_new = cursor.fetchone()
+    inc('bot_support_tickets_total', result='opened' if is_new else 'repeated')
+    return ticket_id, is_new
+
+
+def close_support_ticket(ticket_id, state, operator_user_id):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'UPDATE support_tickets SET state = %s, closed_by = %s, closed_at = current_timestamp '
+            'WHERE id = %s AND state = \'open\' RETURNING order_id, user_id',
+            (state, operator_user_id, ticket_id)
+        )
+        ticket = cursor.fetchone()
+    if ticket:
+        inc('bot_support_tickets_total', result=state)
+        logger.info(f'In func close_support_ticket ticket {ticket_id} {state} by user_id = {operator_user_id}',
+                    extra={'order_id': ticket[0]})
+    return ticket
+
+
+def notify_support_ticket_closed(bot, ticket, state):
+    order_id, user_id = ticket
+    if state == 'refunded':
+        refund_order(order_id)
+        invalidate_order_status(order_id)
+        text = f"The operator is refunding your payment for order {order_id}"
+    else:
+        text = f"The operator resolved your request about order {order_id}"
+    if user_id:
+        send_support_notification(bot, user_id, text)
+
+
+def send_support_notification(bot, chat_id, text, reply_markup=None):
+    for _ in range(SUPPORT_NOTIFY_ATTEMPTS):
+        support_limiter.acquire()
+        try:
+            bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+            inc('bot_support_notifications_total', result='sent')
+            return True
+        except RetryAfter as e:
+            logger.info(f'In func send_support_notification for chat_id = {chat_id} flood limit, '
+                        f'retry after {e.retry_after}')
+            support_limiter.pause(e.retry_after)
+        except TelegramError as e:
+            logger.error(f'In func send_support_notification for chat_id = {chat_id} error: {e}')
+            break
+    inc('bot_support_notifications_total', result='failed')
+    return False
+
+
+def assign_support_tickets(cursor, operators):
+    # New tickets and those of operators no longer configured go to whoever has the fewest open ones
+    cursor.execute(
+        'SELECT operator_id, count(*) FROM support_tickets '
+        'WHERE state = \'open\' AND operator_id = ANY(%s) GROUP BY operator_id',
+        (operators,)
+    )
+    load = dict.fromkeys(operators, 0)
+    load.update(cursor.fetchall())
+    cursor.execute(
+        'SELECT id FROM support_tickets WHERE state = \'open\' AND (operator_id IS NULL OR operator_id <> ALL(%s)) '
+        'ORDER BY id',
+        (operators,)
+    )
+    assignments = []
+    for ticket_id, in cursor.fetchall():
+        operator = min(operators, key=load.get)
+        load[operator] += 1
+        assignments.append((ticket_id, operator))
+    execute_values(
+        cursor,
+        'UPDATE support_tickets AS t SET operator_id = a.operator_id, notified_at = NULL '
+        'FROM (VALUES %s) AS a(id, operator_id) WHERE t.id = a.id',
+        assignments
+    )
+    return load
+
+
+def support_digest(tickets, open_tickets, pending):
+    lines = [f"Support: {len(tickets)} new of {open_tickets} open tickets"]
+    for ticket_id, order_id, username, reason, requests in tickets:
+        repeated = f", asked {requests} times" if requests > 1 else ""
+        lines.append(f"#{ticket_id} order {order_id} from @{username}: {reason}{repeated}")
+    if pending:
+        lines.append(f"{pending} more new tickets follow in the next digest")
+    keyboard = [[InlineKeyboardButton(f"✅ Resolve #{ticket_id}", callback_data=f'resolve_{ticket_id}'),
+                 InlineKeyboardButton(f"↩️ Refund #{ticket_id}", callback_data=f'refund_{ticket_id}')]
+                for ticket_id, *_ in tickets]
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def send_support_digest(context: CallbackContext):
+    operators = support_operators()
+    if not operators:
+        logger.warning('In func send_support_digest neither support_operators nor help_user_id is set')
+        return
+    # Tickets are assigned and picked in one short transaction, the sends wait on Telegram and run outside of it
+    digests = []
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (SUPPORT_DIGEST_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            return
+        load = assign_support_tickets(cursor, operators)
+        # One message per operator and interval however many tickets come in, the rest waits for the next one
+        for operator in operators:
+            cursor.execute(
+                'SELECT id, order_id, username, reason, requests, count(*) OVER () FROM support_tickets '
+                'WHERE state = \'open\' AND operator_id = %s AND notified_at IS NULL ORDER BY id LIMIT %s',
+                (operator, settings.support_digest_size)
+            )
+            rows = cursor.fetchall()
+            if rows:
+                digests.append((operator, [row[:5] for row in rows], rows[0][5] - len(rows)))
+    for operator, tickets, pending in digests:
+        text, reply_markup = support_digest(tickets, load[operator], pending)
+        if not send_support_notification(context.bot, operator, text, reply_markup):
+            continue
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute('UPDATE support_tickets SET notified_at = current_timestamp WHERE id = ANY(%s)',
+                           ([ticket[0] for ticket in tickets],))
+        logger.info(f'In func send_support_digest sent {len(tickets)} tickets to operator {operator}')
+
+
+class IPNNumber(float):
+    # Keeps the literal from the callback body, json.dumps would write 0.00008 as 8e-05
+    def __new__(cls, text):
+        number = super().__new__(cls, text)
+        number.text = text
+        return number
+
+
+def ipn_json(value):
+    # JSON.stringify output of the sorted body: no spaces, non-ASCII text as is, numbers as NOWPayments sent them
+    if isinstance(value, dict):
+        return '{' + ','.join(f'{ipn_json(key)}:{ipn_json(value[key])}' for key in sorted(value)) + '}'
+    if isinstance(value, list):
+        return '[' + ','.join(ipn_json(item) for item in value) + ']'
+    if isinstance(value, IPNNumber):
+        return value.text
+    return json.dumps(value, ensure_ascii=False)
+
+
+def sign_ipn(data):
+    # NOWPayments signs the JSON body with sorted keys using HMAC-SHA512 and the IPN secret
+    return hmac.new(IPN_SECRET.encode(), ipn_json(data).encode(), hashlib.sha512).hexdigest()
+
+
+def verify_ipn_signature(body, signature):
+    try:
+        data = json.loads(body, parse_float=IPNNumber)
+    except ValueError:
+        return None
+    expected = sign_ipn(data)
+    if not signature or not hmac.compare_digest(expected.encode(), signature.encode()):
+        return None
+    return data
+
+
+def save_payment_status(invoice_id, status):
+    # Repeated callbacks with the same status update nothing, a finished payment can only become refunded
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'UPDATE transactions SET payment_status = %(status)s, is_paid = is_paid OR %(status)s = \'finished\', '
+            f'state = {ORDER_STATE_TRANSITION.format(status="%(status)s")} '
+            'WHERE invoice_id = %(invoice_id)s AND payment_status IS DISTINCT FROM %(status)s '
+            'AND (payment_status IS DISTINCT FROM \'finished\' OR %(status)s = \'refunded\') '
+            'RETURNING uuid, user_id',
+            {'status': status, 'invoice_id': invoice_id}
+        )
+        changed = cursor.fetchall()
+    logger.info('In func save_payment_status status = %s changed = %s', status, changed,
+                extra={'invoice_id': invoice_id})
+    return changed
+
+
+def notify_payment_status(bot, user_id, order_id, status):
+    if not user_id or status not in NOTIFY_PAYMENT_STATUSES:
+        return
+    keyboard = [
+        [InlineKeyboardButton("Check transaction", callback_data=f'check_{order_id}')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        bot.send_message(chat_id=user_id,
+                         text=f"Payment status for order {order_id} changed to \"{status}\". "
+                              f"Press \"Check transaction\" to see details",
+                         reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f'In func notify_payment_status for order_id = {order_id} error: {e}')
+
+
+def process_ipn(bot, data):
+    invoice_id = data.get('invoice_id')
+    status = data.get('payment_status')
+    if invoice_id is None or not status:
+        logger.info(f'In func process_ipn skip callback without invoice_id or status: {data.get("payment_id")}')
+        return
+    inc('bot_payment_status_total', source='ipn', status=status)
+    changed = save_payment_status(str(invoice_id), status)
+    if changed and status in STOCK_RELEASE_STATUSES:
+        release_invoice_stock(str(invoice_id))
+    for order_id, user_id in changed:
+        invalidate_order_status(order_id)
+        notify_payment_status(bot, user_id, order_id, status)
+
+
+# Every webhook peer runs the reconcile job, the advisory lock keeps them from notifying users twice
+RECONCILE_LOCK_ID = 7245003
+
+
+def get_open_transactions():
+    # Older invoices are polled less often: the backoff doubles with every hour of age up to the maximum
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            'SELECT invoice_id, payment_status, payment_timestamp FROM transactions '
+            'WHERE is_paid = FALSE AND invoice_id IS NOT NULL '
+            'AND payment_timestamp > current_timestamp - make_interval(secs => %s) '
+            'AND (payment_status IS NULL OR payment_status NOT IN %s) '
+            'AND (status_checked_at IS NULL OR status_checked_at < current_timestamp - make_interval(secs => '
+            'LEAST(%s * power(2, floor(extract(epoch FROM current_timestamp - payment_timestamp) / 3600)), %s)))',
+            (settings.invoice_lifetime, FINAL_PAYMENT_STATUSES, settings.reconcile_min_backoff,
+             settings.reconcile_max_backoff)
+        )
+        return cursor.fetchall()
+
+
+def get_payments_page(token, page, date_from):
+    params = {"limit": RECONCILE_BATCH_SIZE, "page": page, "dateFrom": date_from,
+              "sortBy": "created_at", "orderBy": "asc"}
+    with payments_slots:
+        return get_payments(token, params)
+
+
+def fetch_payment_statuses(date_from):
+    # One paged listing covers every invoice, instead of a payment lookup per invoice
+    token = get_auth_token()
+    first_page = get_payments_page(token, 0, date_from)
+    pages = [first_page]
+    pages.extend(payments_executor.map(lambda page: get_payments_page(token, page, date_from),
+                                       range(1, first_page.get('pagesCount', 1))))
+    statuses = {}
+    for page in pages:
+        for payment in page.get('data', []):
+            # Sorted by creation time, so the latest payment of an invoice wins
+            if payment.get('invoice_id') is not None:
+                statuses[str(payment['invoice_id'])] = payment.get('payment_status')
+    return statuses
+
+
+def save_reconciled_statuses(checked):
+    with get_connection() as conn, conn.cursor() as cursor:
+        return execute_values(
+            cursor,
+            'UPDATE transactions AS t SET status_checked_at = current_timestamp, '
+            'payment_status = COALESCE(v.status, t.payment_status), '
+            'is_paid = t.is_paid OR COALESCE(v.status = \'finished\', FALSE), '
+            f'state = {ORDER_STATE_TRANSITION.format(status="v.status")} '
+            'FROM (VALUES %s) AS v(invoice_id, status) '
+            'WHERE t.invoice_id = v.invoice_id RETURNING t.uuid, t.user_id, t.invoice_id',
+            checked, template='(%s, %s::text)', page_size=RECONCILE_BATCH_SIZE, fetch=True
+        )
+
+
+def reconcile_payments(context: CallbackContext):
+    with job_lock(RECONCILE_LOCK_ID) as is_locked:
+        if is_locked:
+            reconcile_open_transactions(context.bot)
+
+
+def reconcile_open_transactions(bot):
+    open_transactions = get_open_transactions()
+    if not open_transactions:
+        return
+    date_from = min(payment_timestamp for _, _, payment_timestamp in open_transactions).date().isoformat()
+    try:
+        statuses = fetch_payment_statuses(date_from)
+    except (requests.RequestException, ValueError) as e:
+        logger.error(f'In func reconcile_open_transactions error: {e}')
+        return
 
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CallbackQueryHandler(button_click))
+    previous_statuses = {invoice_id: status for invoice_id, status, _ in open_transactions}
+    checked = [(invoice_id, statuses.get(invoice_id)) for invoice_id in previous_statuses]
+    updated = save_reconciled_statuses(checked)
+    logger.info(f'In func reconcile_open_transactions checked {len(checked)} invoices, '
+                f'found {sum(1 for _, status in checked if status)} payments')
+    for order_id, user_id, invoice_id in updated:
+        status = statuses.get(invoice_id)
+        if status and status != previous_statuses[invoice_id]:
+            inc('bot_payment_status_total', source='reconcile', status=status)
+            if status in STOCK_RELEASE_STATUSES:
+                release_invoice_stock(invoice_id)
+            invalidate_order_status(order_id)
+            notify_payment_status(bot, user_id, order_id, status)
+
+
+def read_request_body(handler, max_size):
+    # The length is checked before reading, so a client can't make the server buffer an arbitrary body
+    try:
+        length = int(handler.headers.get('Content-Length', ''))
+    except ValueError:
+        length = -1
+    if length < 0 or length > max_size:
+        handler.send_response(400 if length < 0 else 413)
+        handler.end_headers()
+        return None
+    return handler.rfile.read(length)
+
+
+class IPNRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = read_request_body(self, IPN_MAX_BODY_SIZE)
+        if body is None:
+            logger.info(f'In IPN handler rejected callback with bad length from {self.client_address[0]}')
+            return
+        data = verify_ipn_signature(body, self.headers.get('x-nowpayments-sig'))
+        if data is None:
+            logger.info(f'In IPN handler rejected callback with invalid signature from {self.client_address[0]}')
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            process_ipn(self.server.bot, data)
+        except Exception as e:
+            # Not acknowledged, so NOWPayments retries the callback later
+            logger.error(f'In IPN handler for invoice_id = {data.get("invoice_id")} error: {e}')
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.info(f'IPN server: {format % args}')
+
+
+def start_ipn_server(bot):
+    server = ThreadingHTTPServer((IPN_HOST, IPN_PORT), IPNRequestHandler)
+    server.bot = bot
+    threading.Thread(target=server.serve_forever, name='ipn-server', daemon=True).start()
+    logger.info(f'IPN server listening on {IPN_HOST}:{IPN_PORT}')
+    return server
+
+
+def send_fake_ipn(url, invoice_id, status, payment_id):
+    # Signed like a NOWPayments callback, to try the IPN endpoint locally without a real payment
+    data = {'payment_id': payment_id, 'invoice_id': invoice_id, 'payment_status': status}
+    headers = {'Content-Type': 'application/json', 'x-nowpayments-sig': sign_ipn(data)}
+    response = requests.post(url, data=ipn_json(data).encode(), headers=headers, timeout=10)
+    print(f'IPN for invoice {invoice_id} with status {status}: HTTP {response.status_code}')
+
+
+# Orders per day and currency in [date_from, date_to). An order counts once even if it got several invoices,
+# transactions from before the catalog have no price and are counted at the configured one.
+SALES_AGGREGATION = '''
+    WITH orders AS (
+        SELECT DISTINCT ON (uuid) payment_timestamp::date AS day, COALESCE(price_currency, 'usd') AS currency,
+               is_paid, COALESCE(price_amount, %(legacy_price)s) AS price_amount
+        FROM transactions
+        WHERE payment_timestamp >= %(date_from)s AND payment_timestamp < %(date_to)s
+        ORDER BY uuid, is_paid DESC, payment_timestamp
+    ), sales AS (
+        SELECT day, currency, count(*) AS created, count(*) FILTER (WHERE is_paid) AS finished,
+               COALESCE(sum(price_amount) FILTER (WHERE is_paid), 0) AS revenue
+        FROM orders
+        GROUP BY day, currency
+    ), problems AS (
+        SELECT i.record_date::date AS day, COALESCE(t.price_currency, 'usd') AS currency,
+               count(DISTINCT i.order_id) AS problem_invoices
+        FROM invoices AS i
+        LEFT JOIN LATERAL (SELECT price_currency FROM transactions WHERE uuid = i.order_id LIMIT 1) AS t ON TRUE
+        WHERE i.record_date >= %(date_from)s AND i.record_date < %(date_to)s
+        GROUP BY 1, 2
+    )
+    SELECT day, currency, COALESCE(s.created, 0) AS created, COALESCE(s.finished, 0) AS finished,
+           COALESCE(s.revenue, 0) AS revenue, COALESCE(p.problem_invoices, 0) AS problem_invoices
+    FROM sales AS s
+    FULL JOIN problems AS p USING (day, currency)
+'''
+
+
+def refresh_daily_sales():
+    # Only days that closed since the last refresh are aggregated, earlier ones are never read again
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(max(day) + 1, \'-infinity\'::date), current_date - %s FROM daily_sales',
+                       (settings.report_settle_days,))
+        date_from, date_to = cursor.fetchone()
+        if date_from >= date_to:
+            return
+        cursor.execute(
+            'INSERT INTO daily_sales (day, currency, created, finished, revenue, problem_invoices) '
+            f'{SALES_AGGREGATION} '
+            'ON CONFLICT (day, currency) DO UPDATE SET created = EXCLUDED.created, finished = EXCLUDED.finished, '
+            'revenue = EXCLUDED.revenue, problem_invoices = EXCLUDED.problem_invoices',
+            {'date_from': date_from, 'date_to': date_to, 'legacy_price': settings.price}
+        )
+        logger.info(f'In func refresh_daily_sales rolled up {cursor.rowcount} rows before {date_to}')
+
+
+def report_query(cursor, days):
+    # Closed days come from the rollup, the still open ones are aggregated on the fly
+    cursor.execute('SELECT current_date')
+    today = cursor.fetchone()[0]
+    settle_days = settings.report_settle_days
+    return cursor.mogrify(
+        'SELECT day, currency, created, finished, '
+        'round(100.0 * finished / NULLIF(created, 0), 1) AS conversion_percent, revenue, problem_invoices '
+        'FROM ('
+        'SELECT day, currency, created, finished, revenue, problem_invoices FROM daily_sales '
+        'WHERE day >= %(first_day)s AND day < %(settled_before)s '
+        f'UNION ALL ({SALES_AGGREGATION})'
+        ') AS report ORDER BY day, currency',
+        {'first_day': today - timedelta(days=days - 1), 'settled_before': today - timedelta(days=settle_days),
+         'date_from': today - timedelta(days=min(days - 1, settle_days)), 'date_to': 'infinity',
+         'legacy_price': settings.price}
+    ).decode()
+
+
+def export_report(days, output):
+    refresh_daily_sales()
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.copy_expert(f'COPY ({report_query(cursor, days)}) TO STDOUT WITH CSV HEADER', output)
+
+
+def export_users(output, after_user_id=0):
+    # One user_id per line in user_id order, an interrupted export resumes with the last id written
+    for user_id in get_all_users(after_user_id):
+        output.write(f'{user_id}\n')
+
+
+def summarize_report(days):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            f'SELECT currency, sum(created), sum(finished), sum(revenue), sum(problem_invoices) '
+            f'FROM ({report_query(cursor, days)}) AS report GROUP BY currency ORDER BY currency'
+        )
+        return cursor.fetchall()
 
-    dp.add_handler(CallbackQueryHandler(button_click, pattern='button_click'))
 
-    dp.add_handler(CommandHandler("send_message_to_all", send_message_to_all))
+def send_report(update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    if user_id not in settings.admins:
+        logger.info(f'In func send_report user_id = {user_id}. {user_id} don\'t have permissions for this command!')
+        update.message.reply_text("You don't have permissions for this command")
+        return
+    try:
+        days = int(context.args[0]) if context.args else settings.report_days
+    except ValueError:
+        days = 0
+    if days < 1:
+        update.message.reply_text("Usage: /report [days]")
+        return
+    # The CSV is spooled to disk by COPY, so a long history is never held in memory
+    with tempfile.TemporaryFile(mode='w+b') as report_file:
+        export_report(days, report_file)
+        report_file.seek(0)
+        lines = [f"Sales for the last {days} days:"]
+        for currency, created, finished, revenue, problem_invoices in summarize_report(days):
+            conversion = 100 * finished / created if created else 0
+            lines.append(f"{currency}: {finished} of {created} orders paid ({conversion:.1f}%), "
+                         f"revenue {revenue}, problem invoices {problem_invoices}")
+        update.message.reply_text("\n".join(lines))
+        context.bot.send_document(chat_id=update.message.chat_id, document=report_file,
+                                  filename=f'report_{date.today().isoformat()}_{days}d.csv')
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_metrics():
+    lines = []
+    with metrics_lock:
+        histograms = sorted(metric_histograms.items())
+        counters = sorted(metric_counters.items())
+    typed = set()
+    for (name, labels), (buckets, total, count) in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} histogram')
+        for bound, bucket_count in zip(METRIC_BUCKETS, buckets):
+            lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {bucket_count}')
+        lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{name}_count{format_labels(labels)} {count}')
+    for (name, labels), value in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name}{format_labels(labels)} {value}')
+
+    # Values kept by the subsystems themselves
+    update_metrics = get_update_metrics()
+    samples = [('gauge', 'bot_update_queue_depth', (), update_metrics['queued_updates']),
+               ('gauge', 'bot_busy_users', (), update_metrics['busy_users']),
+               ('gauge', 'bot_webhook_queue_depth', (), webhook_queue.qsize()),
+               ('gauge', 'bot_payments_circuit_open', (), int(payments_circuit['state'] != 'closed'))]
+    samples += [('counter', 'bot_auth_token_cache_total', (('result', key),), value)
+                for key, value in auth_token_stats.items()]
+    samples += [('counter', 'bot_check_status_cache_total', (('result', key),), value)
+                for key, value in check_status_stats.items()]
+    for metric_type, name, labels, value in samples:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {metric_type}')
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server():
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f'Metrics server listening on {METRICS_HOST}:{METRICS_PORT}')
+    return server
+
+
+update_executor = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix='updates')
+slow_update_executor = ThreadPoolExecutor(max_workers=SLOW_UPDATE_WORKERS, thread_name_prefix='slow-updates')
+# user_id -> pending (handler, update, context, executor, enqueued_at); while a user has an entry,
+# exactly one of its updates is running or scheduled, the rest wait in order
+user_update_queues = {}
+user_update_lock = threading.Lock()
+user_update_state = {'queued': 0}
+
+
+def get_update_metrics():
+    with user_update_lock:
+        return {
+            'queued_updates': user_update_state['queued'],
+            'busy_users': len(user_update_queues),
+        }
+
+
+def run_user_update(user_id):
+    with user_update_lock:
+        handler, update, context, _, enqueued_at = user_update_queues[user_id].popleft()
+        user_update_state['queued'] -= 1
+    started = time.monotonic()
+    try:
+        handler(update, context)
+    except Exception as e:
+        logger.exception(f'In func {handler.__name__} for user_id = {user_id} error: {e}')
+    finally:
+        observe('bot_update_queue_wait_seconds', started - enqueued_at)
+        observe('bot_handler_seconds', time.monotonic() - started, handler=handler.__name__)
+        schedule_next_user_update(user_id)
+
+
+def schedule_next_user_update(user_id):
+    with user_update_lock:
+        queue = user_update_queues[user_id]
+        if not queue:
+            del user_update_queues[user_id]
+            return
+        executor = queue[0][3]
+    executor.submit(run_user_update, user_id)
+
+
+def run_in_user_order(handler, is_slow=None):
+    # Updates of one user are handled in arrival order, different users in parallel
+    @functools.wraps(handler)
+    def wrapper(update, context):
+        user = update.effective_user
+        user_id = user.id if user else 0
+        executor = slow_update_executor if is_slow and is_slow(update) else update_executor
+        with user_update_lock:
+            user_update_state['queued'] += 1
+            queue = user_update_queues.get(user_id)
+            if queue is not None:
+                queue.append((handler, update, context, executor, time.monotonic()))
+                return
+            user_update_queues[user_id] = deque([(handler, update, context, executor, time.monotonic())])
+        executor.submit(run_user_update, user_id)
+
+    return wrapper
+
+
+def is_slow_callback(update):
+    return update.callback_query.data.partition('_')[0] in SLOW_CALLBACK_PREFIXES
+
+
+# Updates accepted by the webhook server, fed to the dispatcher by a single thread in arrival order
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_record_lock = threading.Lock()
+webhook_peer_session = requests.Session()
+# Set on updates passed on by another bot process, so a misconfigured peer list can't bounce them around
+WEBHOOK_FORWARDED_HEADER = 'X-Bot-Forwarded'
+WEBHOOK_FORWARD_TIMEOUT = 10
+# A Telegram update with the longest message and caption stays well below this
+WEBHOOK_MAX_BODY_SIZE = 1048576
+
+
+def update_shard(update):
+    # All updates of a user go to the same process, which keeps them in order
+    if not WEBHOOK_PEERS:
+        return WEBHOOK_SHARD
+    user = update.effective_user
+    return (user.id if user else 0) % len(WEBHOOK_PEERS)
+
+
+def record_update(data):
+    with webhook_record_lock, open(WEBHOOK_RECORD_FILE, 'a', encoding='utf-8') as record_file:
+        record_file.write(json.dumps(data) + '\n')
+
+
+def accept_update(update):
+    # Telegram delivers an update again when it is not acknowledged, so a full queue pushes back
+    # instead of growing without bound
+    try:
+        if webhook_queue.qsize() + user_update_state['queued'] >= WEBHOOK_QUEUE_SIZE:
+            raise queue.Full
+        webhook_queue.put_nowait(update)
+    except queue.Full:
+        inc('bot_webhook_updates_total', result='rejected')
+        return 503
+    inc('bot_webhook_updates_total', result='accepted')
+    return 200
+
+
+def forward_update(shard, body):
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET,
+               WEBHOOK_FORWARDED_HEADER: '1'}
+    try:
+        response = webhook_peer_session.post(WEBHOOK_PEERS[shard], data=body, headers=headers,
+                                             timeout=WEBHOOK_FORWARD_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error(f'In func forward_update to shard {shard} error: {e}')
+        return 502
+    inc('bot_webhook_updates_total', result='forwarded')
+    return response.status_code
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.info(f'In webhook handler rejected update with invalid secret from {self.client_address[0]}')
+            self.send_response(403)
+            self.end_headers()
+            return
+        body = read_request_body(self, WEBHOOK_MAX_BODY_SIZE)
+        if body is None:
+            logger.info(f'In webhook handler rejected update with bad length from {self.client_address[0]}')
+            return
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, self.server.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.info(f'In webhook handler rejected malformed update: {e}')
+            update = None
+        if update is None:
+            self.send_response(400)
+            self.end_headers()
+            return
+        shard = update_shard(update)
+        if shard != WEBHOOK_SHARD and not self.headers.get(WEBHOOK_FORWARDED_HEADER):
+            status = forward_update(shard, body)
+        else:
+            status = accept_update(update)
+            if status == 200 and WEBHOOK_RECORD_FILE:
+                record_update(data)
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def dispatch_webhook_updates(dispatcher):
+    while True:
+        update = webhook_queue.get()
+        if update is None:
+            return
+        dispatcher.process_update(update)
+
+
+def start_webhook_server(updater):
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+    server.bot = updater.bot
+    threading.Thread(target=dispatch_webhook_updates, args=(updater.dispatcher,), name='webhook-dispatcher',
+                     daemon=True).start()
+    threading.Thread(target=server.serve_forever, name='webhook-server', daemon=True).start()
+    updater.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info(f'Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT} as shard {WEBHOOK_SHARD}')
+    return server
+
+
+def wait_for_stop_signal():
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda *args: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+
+
+def replay_updates(path, url, connections):
+    # Posts recorded updates like Telegram does, retrying the ones the server pushed back on
+    with open(path, encoding='utf-8') as record_file:
+        bodies = [line.strip().encode() for line in record_file if line.strip()]
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=connections))
+    session.mount('https://', HTTPAdapter(pool_maxsize=connections))
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+    stats = {'accepted': 0, 'retried': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    def send(body):
+        result = 'failed'
+        for attempt in range(10):
+            try:
+                status = session.post(url, data=body, headers=headers, timeout=WEBHOOK_FORWARD_TIMEOUT).status_code
+            except requests.RequestException:
+                status = None
+            if status == 200:
+                result = 'accepted'
+                break
+            if status not in (None, 429, 502, 503):
+                break
+            with stats_lock:
+                stats['retried'] += 1
+            time.sleep(min(0.05 * 2 ** attempt, 1))
+        with stats_lock:
+            stats[result] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(send, bodies))
+    elapsed = time.monotonic() - started
+    print(f'{len(bodies)} updates in {elapsed:.2f} s ({len(bodies) / elapsed:.0f} updates/s): '
+          f'{stats["accepted"]} accepted, {stats["retried"]} retries, {stats["failed"]} failed')
+
+
+def main():
+    # Every update, slow update and broadcast worker may call the Bot API at the same time
+    request = TimedRequest(con_pool_size=UPDATE_WORKERS + SLOW_UPDATE_WORKERS + BROADCAST_WORKERS + 4)
+    # telegram_api_url points the bot at a local Bot API server or a fake one for load tests
+    updater = Updater(bot=Bot(TOKEN, base_url=TELEGRAM_API_URL or None, request=request), use_context=True)
+    dp = updater.dispatcher
 
-    updater.start_polling()
-    updater.idle()
+    dp.add_handler(CommandHandler("start", run_in_user_order(start)))
+    dp.add_handler(CommandHandler("search", run_in_user_order(search_catalog)))
+    dp.add_handler(CallbackQueryHandler(run_in_user_order(button_click, is_slow_callback)))
+
+    dp.add_handler(CommandHandler("send_message_to_all", run_in_user_order(send_message_to_all)))
+    dp.add_handler(CommandHandler("preupload_media", run_in_user_order(preupload_broadcast_media)))
+    dp.add_handler(CommandHandler("report", run_in_user_order(send_report)))
+
+    catalog_listener = start_catalog_listener()
+    ipn_server = start_ipn_server(updater.bot) if IPN_ENABLED else None
+    metrics_server = start_metrics_server() if METRICS_PORT else None
+    if RECONCILE_ENABLED:
+        updater.job_queue.run_repeating(reconcile_payments, interval=RECONCILE_INTERVAL, first=RECONCILE_INTERVAL)
+    updater.job_queue.run_repeating(flush_last_interactions, interval=LAST_INTERACTION_FLUSH_INTERVAL)
+    if CONFIG_WATCH_INTERVAL:
+        updater.job_queue.run_repeating(reload_config, interval=CONFIG_WATCH_INTERVAL)
+    if INVOICE_POOL_ENABLED:
+        updater.job_queue.run_repeating(refill_invoice_pool, interval=INVOICE_POOL_REFILL_INTERVAL, first=0)
+    # Always scheduled, support_operators and help_user_id may be set by a config reload later on
+    updater.job_queue.run_repeating(send_support_digest, interval=SUPPORT_DIGEST_INTERVAL)
+    if STOCK_RELEASE_INTERVAL:
+        updater.job_queue.run_repeating(release_expired_reservations, interval=STOCK_RELEASE_INTERVAL)
+
+    if WEBHOOK_ENABLED:
+        webhook_server = start_webhook_server(updater)
+        updater.job_queue.start()
+        wait_for_stop_signal()
+        webhook_server.shutdown()
+        webhook_queue.put(None)
+        updater.job_queue.stop()
+    else:
+        updater.start_polling()
+        updater.idle()
+    catalog_listener.set()
+    if ipn_server:
+        ipn_server.shutdown()
+    if metrics_server:
+        metrics_server.shutdown()
+    update_executor.shutdown(wait=True)
+    slow_update_executor.shutdown(wait=True)
+    flush_last_interactions()
+    payments_executor.shutdown(wait=False)
+    payments_session.close()
+    db_pool.closeall()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Telegram store bot')
+    commands = parser.add_subparsers(dest='command')
+    report_parser = commands.add_parser('report', help='export daily sales as CSV instead of running the bot')
+    report_parser.add_argument('--days', type=int, default=settings.report_days, help='number of days up to today')
+    report_parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                               help='CSV file, stdout by default')
+    users_parser = commands.add_parser('users', help='export the ids of users who did not block the bot')
+    users_parser.add_argument('--after', type=int, default=0, help='resume after this user_id')
+    users_parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                              help='file with one user_id per line, stdout by default')
+    replay_parser = commands.add_parser('replay', help='post updates recorded by webhook_record_file to a webhook')
+    replay_parser.add_argument('path', help='file with one update JSON per line')
+    replay_parser.add_argument('--url', default=f'http://127.0.0.1:{WEBHOOK_PORT}/', help='webhook server to post to')
+    replay_parser.add_argument('--connections', type=int, default=WEBHOOK_MAX_CONNECTIONS,
+                               help='updates posted in parallel, like max_connections of setWebhook')
+    ipn_parser = commands.add_parser('ipn', help='post a signed payment callback to the IPN endpoint')
+    ipn_parser.add_argument('invoice_id', help='invoice_id of the transaction')
+    ipn_parser.add_argument('status', choices=['finished', *PAYMENT_STATUS_REPLIES], help='payment_status to report')
+    ipn_parser.add_argument('--payment-id', default='0', help='payment_id to report')
+    ipn_parser.add_argument('--url', default=f'http://127.0.0.1:{IPN_PORT}/', help='IPN endpoint to post to')
+    args = parser.parse_args()
+    if args.command == 'report':
+        export_report(args.days, args.output)
+        db_pool.closeall()
+    elif args.command == 'users':
+        export_users(args.output, args.after)
+        db_pool.closeall()
+    elif args.command == 'ipn':
+        send_fake_ipn(args.url, args.invoice_id, args.status, args.payment_id)
+    elif args.command == 'replay':
+        replay_updates(args.path, args.url, args.connections)
+    else:
+        main()